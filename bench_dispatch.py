@@ -0,0 +1,122 @@
+"""
+Benchmark of bot3 update throughput: page handlers run in the dispatcher thread vs in worker threads (run_async).
+Bot API is stubbed with fixed latency per request, database is a real MongoDB with scratch items.
+
+Usage:
+python bench_dispatch.py --url mongodb://localhost:27017 --chats 50 --latency 0.05 --workers 8
+
+Every chat opens the menu by /start and then asks for a search page, only search updates are timed.
+"""
+import sys
+import time
+import argparse
+import threading
+from itertools import count
+
+import pymongo
+from telegram import Bot as TelegramBot, Update
+from telegram.ext import Updater
+from telegram.utils.request import Request
+
+import constants as C
+import database as DB
+import bot3
+import fake_telegram
+from bot3 import SEARCHING
+
+
+class StubRequest(Request):
+    """Answers every Bot API method after fixed latency, without network"""
+
+    __slots__ = ('latency',)
+
+    def __init__(self, latency: float, pool_size: int):
+        super().__init__(con_pool_size=pool_size)  # Updater checks it against workers
+        self.latency = latency
+
+    def post(self, url, data, timeout=None):
+        time.sleep(self.latency)
+        return fake_telegram.answer(url.rsplit('/', 1)[-1], data)
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}] if text.startswith('/') else [],
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}}}
+
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': str(chat_id), 'data': data,
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+        'message': {'message_id': update_id, 'date': 0, 'text': 'menu', 'chat': {'id': chat_id, 'type': 'private'}}}}
+
+
+def seed(db, chats: int):
+    db["items"].drop()
+    db["transactions"].drop()
+    DB.ensure_indexes(db)
+    db["items"].insert_many([{"chat_id": chat_id, "owner_name": f"user{chat_id}", "Name": f"item{chat_id}",
+                              "Value": "10", "value_cents": 1000,
+                              "Description": "benchmark"} for chat_id in range(1, chats + 1)])
+
+
+def bench(bot: bot3.Bot, telegram_bot: TelegramBot, chats: int, workers: int, run_async: bool) -> float:
+    """Search updates per second"""
+    done = threading.Semaphore(0)
+    search = bot.search
+
+    def timed_search(update, context):
+        try:
+            return search(update, context)
+        finally:
+            done.release()
+
+    bot.search = timed_search  # handlers are bound at registration
+    updater = Updater(bot=telegram_bot, workers=workers)
+    bot.add_handlers(updater.dispatcher, run_async=run_async)
+    del bot.search
+    dispatcher = updater.dispatcher
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+    update_ids = count(1)
+
+    for chat_id in range(1, chats + 1):
+        dispatcher.process_update(Update.de_json(message_update(next(update_ids), chat_id, '/start'), telegram_bot))
+
+    started = time.perf_counter()
+    for chat_id in range(1, chats + 1):
+        dispatcher.update_queue.put(Update.de_json(callback_update(next(update_ids), chat_id, SEARCHING), telegram_bot))
+    for _ in range(chats):
+        done.acquire()
+    elapsed = time.perf_counter() - started
+
+    dispatcher.stop()
+    thread.join()
+    return chats / elapsed
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="bot3 dispatcher throughput with stubbed Bot API")
+    parser.add_argument("--url", default=C.MONGODB_CONNECTION_URL)
+    parser.add_argument("--db", default="bench_botDB")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per Bot API request")
+    parser.add_argument("--workers", type=int, default=C.DISPATCHER_WORKERS)
+    args = parser.parse_args(argv)
+
+    db = pymongo.MongoClient(args.url)[args.db]
+    seed(db, args.chats)
+    bot = bot3.Bot(db, speech_backends="")  # no connection to the database or speech service of settings
+    telegram_bot = TelegramBot("123456:bench", request=StubRequest(args.latency, args.workers + 4))
+
+    for run_async in (False, True):
+        rate = bench(bot, telegram_bot, args.chats, args.workers, run_async)
+        print(f"{'worker threads' if run_async else 'dispatcher thread'}: {rate:.1f} updates/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""
+Content-addressed storage of bot1 uploads.
+Uploaded file is named by SHA-256 of its content, the same content is kept once.
+Blobs not referenced by any TradeItem are removed by garbage collection.
+"""
+import os
+import time
+import hashlib
+import logging
+from collections import Counter
+from typing import Callable, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def refcounts(names: Iterable[str]) -> Counter:
+    """Number of references to every blob name"""
+    return Counter(name for name in names if name != "")
+
+
+class BlobStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def put(self, path: str, suffix: str = "") -> str:
+        """Move file into the store, returns blob name. Duplicate content is dropped."""
+        name = file_digest(path) + suffix
+        blob_path = os.path.join(self.directory, name)
+        if (os.path.abspath(path) == os.path.abspath(blob_path)):
+            return name
+        if (os.path.isfile(blob_path)):
+            os.remove(path)
+        else:
+            os.replace(path, blob_path)
+        return name
+
+    def collect_garbage(self, referenced: Counter, grace_seconds: float, keep: Callable[[str], bool] = None) -> List[str]:
+        """
+        Remove files without references, older than grace period.
+        Grace period protects uploads of conversations in progress.
+        """
+        removed = []
+        expiry = time.time() - grace_seconds
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if (referenced[name] > 0 or (keep is not None and keep(name)) or not os.path.isfile(path)):
+                continue
+            if (os.path.getmtime(path) < expiry):
+                try:
+                    os.remove(path)
+                    removed.append(name)
+                except OSError as e:
+                    logger.warning(f"Could not remove {path}: {e}")
+        return removed
@@ -1,5 +1,6 @@
 import os
 import logging
+import functools
 from telegram.ext import (
     Updater,
     CommandHandler,
@@ -8,9 +9,13 @@ from telegram.ext import (
     ConversationHandler,
     PicklePersistence,
     CallbackContext,
+    TypeHandler,
 )
+from telegram import Update
 import bot1_responses as R
+from persistence import BatchedPersistence, SQLiteStore
 import constants as C
+import runtime
 #from constants import TELEGRAM_TOKEN, HEROKU_APP_NAME, HEROKU_PORT
 import trade_types as T
 
@@ -21,59 +26,55 @@ import trade_types as T
 #logger = logging.getLogger(__name__)
 
 
-def main():
-    R.read_journal()
-    # Create the Updater and pass it your bot's token.
-    #persistence = PicklePersistence(filename='conversationbot')
-    # , persistence=persistence)
-    updater = Updater(C.TELEGRAM_TOKEN, use_context=True)
-    dp = updater.dispatcher
+def add_handlers(dp):
     dp.add_handler(CommandHandler("start", R.start_command))
     dp.add_handler(CommandHandler("help", R.help_command))
 
     # Add conversation handler
     conv_handler = ConversationHandler(
+        name="trade",
+        persistent=True,
         entry_points=[CommandHandler('trade', R.start_conv)],
         states={
             T.Q1: [MessageHandler(Filters.regex('^(File|Coupon|Other)$'), R.type_conv)],
             T.Q2: [MessageHandler(Filters.text & ~Filters.command, R.item_conv)],
             T.Q3: [MessageHandler(Filters.text, R.value_conv)],#Filters.regex('^(\d*[.,]?[\d*]?)$')
             T.Q4: [MessageHandler(Filters.photo, R.photo_conv), CommandHandler('skip', R.skip_photo_conv)],
-            T.Q5: [MessageHandler(Filters.document, R.document_conv), CommandHandler('skip', R.skip_document_conv)],
-            T.Q6: [MessageHandler(Filters.text & ~Filters.command, R.location_conv), CommandHandler('skip', R.skip_location_conv)],
+            T.Q5: [MessageHandler(Filters.document, R.document_conv), CommandHandler('skip', R.skip_document_conv),
+                   MessageHandler(Filters.photo, R.photo_conv)], #rest of album photos
+            T.Q6: [MessageHandler(Filters.text & ~Filters.command, R.location_conv), CommandHandler('skip', R.skip_location_conv),
+                   MessageHandler(Filters.photo, R.photo_conv)], #rest of album photos
             T.Q7: [MessageHandler(Filters.text & ~Filters.command, R.description_conv)],
             T.Q8: [MessageHandler(Filters.regex('^(Confirm|Cancel)$'), R.commit_conv)],
             T.Q9: [MessageHandler(Filters.text & ~Filters.command, R.download_conv)],
         },
         fallbacks=[CommandHandler('stop', R.stop_conv)],
+        conversation_timeout=C.TRADE_SESSION_TTL,
     )
     dp.add_handler(conv_handler)
+    # trade item of a conversation restored after restart goes back to sessions before conversation handler,
+    # expired one ends the conversation
+    dp.add_handler(TypeHandler(Update, functools.partial(R.restore_session, conversation=conv_handler)), group=-1)
 
     dp.add_handler(MessageHandler(Filters.text, R.handle_message))
     dp.add_error_handler(R.error)
 
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    # updater.start_polling(1)
-    #updater.start_webhook(listen="0.0.0.0", port=int(PORT), url_path=C.API_KEY)
-    #updater.bot.setWebhook("https://{}.herokuapp.com/{}",C.HEROKU_APPNAME, C.API_KEY)
 
+def create_updater():
+    """Updater with persistence, handlers and jobs of the bot, not started yet"""
+    persistence = BatchedPersistence(SQLiteStore(R.conversations_path), R.unexpired_user_data)
+    updater = runtime.new_updater(persistence)
+    add_handlers(updater.dispatcher)
+    updater.job_queue.run_repeating(R.collect_garbage, interval=C.BLOB_GC_INTERVAL, first=C.BLOB_GC_INTERVAL)
+    updater.job_queue.run_repeating(R.evict_sessions, interval=C.TRADE_SESSION_TTL, first=C.TRADE_SESSION_TTL)
+    updater.job_queue.run_repeating(persistence.flush_job, interval=C.PERSISTENCE_FLUSH_INTERVAL)
+    return updater
 
-    # Run bot
-    if C.HEROKU_APP_NAME=="":  # pooling mode
-        print("Can't detect 'HEROKU_APP_NAME' env. Running bot in pooling mode.")
-        #print("Note: this is not a great way to deploy the bot in Heroku.")
-        updater.start_polling(1)
-    else:  # webhook mode
-        #print(f"Running bot in webhook mode. Make sure that this url is correct: https://{C.HEROKU_APP_NAME}.herokuapp.com/")
-        PORT = int(os.environ.get('PORT', C.HEROKU_PORT))
-        updater.start_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=C.TELEGRAM_TOKEN,
-            webhook_url=f"https://{C.HEROKU_APP_NAME}.herokuapp.com/{C.TELEGRAM_TOKEN}"
-        )
 
-    updater.idle()
+def main():
+    R.read_journal()
+    # the bot's trade-in item lives in this process, so bot1 is not sharded to webhook worker processes
+    runtime.run(create_updater)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,10 +1,17 @@
-from typing import Dict
+from typing import Dict, List
 import os.path
+import threading
+import time
 import re
 from telegram.keyboardbutton import KeyboardButton
 from telegram.keyboardbuttonpolltype import KeyboardButtonPollType
 import trade_types as T
 import constants as C
+from journal import Journal
+from thumbnails import ThumbnailPipeline
+from downloads import Downloader, FileTooLarge, best_photo_size
+from blobstore import BlobStore, refcounts
+from sessions import BotItem, TradeSessions
 from datetime import datetime
 from io import BytesIO
 #from pathlib import Path
@@ -28,18 +35,40 @@ from telegram.ext import (
 )
 
 # global variables
-bot_item = T.TradeItem("")  # bot holds current item to trade with
-trade_items = {}  # collection of users' items in chat
-journal_path = "{}/journal.csv".format(C.DATA_PATH.strip('/'))
+current_item = BotItem(T.TradeItem(""))  # bot holds current item to trade with
+trade_items = TradeSessions()  # collection of users' items in chat
+# user_data of a trade conversation, persisted to continue it after restart
+session_keys = ('trade_item', 'trade_with', 'trade_touched')
+journal_path = "{}/journal.db".format(C.DATA_PATH.strip('/'))
+legacy_journal_path = "{}/journal.csv".format(C.DATA_PATH.strip('/'))
+conversations_path = "{}/conversations.db".format(C.DATA_PATH.strip('/'))
+journal = None
 images_dir = "{}/images/".format(C.DATA_PATH.strip('/'))
 files_dir = "{}/files/".format(C.DATA_PATH.strip('/'))
 thumbnails_dir = "{}/thumbnails/".format(C.DATA_PATH.strip('/'))
 thumbnail_size = int(C.THUMBNAIL_SIZE)
 bot_item_image_path = thumbnails_dir+"bot_image.jpg"
+thumbnail_pipeline = ThumbnailPipeline()
+downloader = Downloader()
+# committed uploads are named by content digest: images as <digest>.jpg, files as <digest>
+# with journal entries "<digest>_<file name>"
+image_store = BlobStore(images_dir)
+file_store = BlobStore(files_dir)
+watermark_text = "Creative Trade-in"
+try:
+    watermark_font = ImageFont.truetype('arial.ttf', 18)
+except IOError:
+    watermark_font = ImageFont.load_default()
+# composite image of current bot item, rebuilt only when its images or render parameters change
+bot_image_lock = threading.Lock()
+bot_image_key = None
+bot_image_bytes = None
+bot_image_file_id = None  # telegram file id of uploaded composite, reused by /start
+blobs_lock = threading.Lock()
 
 
 def read_journal():
-    global bot_item
+    global journal
     if not os.path.exists(C.DATA_PATH):
         os.makedirs(C.DATA_PATH)
     if not os.path.exists(images_dir):
@@ -49,93 +78,228 @@ def read_journal():
     if not os.path.exists(thumbnails_dir):
         os.makedirs(thumbnails_dir)
 
-    if (os.path.isfile(journal_path) == False):
-        with open(journal_path, 'w+', encoding='utf-8') as j:
-            j.write(T.TradeItem.header)
-    else:
-        with open(journal_path, 'r', encoding='utf-8') as j:
-            bot_item = T.TradeItem(j.readlines()[-1])
-            update_bot_image()
+    journal = Journal(journal_path, item_blobs)
+    journal.import_csv(legacy_journal_path)
+    last_item = journal.last()
+    if (last_item is not None):
+        current_item.reset(last_item)
+        update_bot_image()
 
 
-def write_journal():
-    global bot_item
-    if (os.path.isfile(journal_path) == True):
-        with open(journal_path, 'a', encoding='utf-8') as j:
-            j.write("\n{}".format(bot_item.to_string()))
+def write_journal(item):
+    journal.append(item)
 
 
-def update_bot_image():
-    global bot_item
-    if (os.path.isfile(bot_item_image_path)):
-        os.remove(bot_item_image_path)
-    # print(bot_item.Images)
-    if (bot_item.Images != ""):
-        image_list = bot_item.Images.split(",")
-        photos = []
-        for image_name in image_list:
-            path = images_dir + image_name
-            pathThumbnail = thumbnails_dir + "t_" + image_name
-            if (os.path.isfile(pathThumbnail) == False):
-                try:
-                    image = Image.open(path)
-                    image.thumbnail((thumbnail_size, thumbnail_size))
-                    image.save(pathThumbnail)
-                except IOError:
-                    pass
-
-            if (os.path.isfile(pathThumbnail) == False):
-                pathThumbnail = path
-            photos.append(pathThumbnail)
-
-        if (len(photos) == 1):
-            new_image = Image.open(photos[0])
+def thumbnail_path(image_name):
+    return thumbnails_dir + "t_" + image_name
+
+
+def file_blob_path(entry):
+    """Path of file entry of item Location, entries saved before blob store are plain file names"""
+    blob_path = files_dir + entry.split("_", 1)[0]
+    if (os.path.isfile(blob_path)):
+        return blob_path
+    return files_dir + entry
+
+
+def item_blobs(item) -> List[str]:
+    """Names on disk of images and files of the item"""
+    # entries saved before blob store are plain file names, they are counted under the name on disk
+    return ([name for name in item.Images.split(",") if name != ""] +
+            [os.path.basename(file_blob_path(entry)) for entry in item.Location.split(",") if entry != ""])
+
+
+def store_uploads(item):
+    """Move uploaded images and files of the item into blob stores and rename them in the item"""
+    image_names = [name for name in item.Images.split(",") if name != ""]
+    file_names = [name for name in item.Location.split(",") if name != ""]
+    downloader.wait([images_dir + name for name in image_names] + [files_dir + name for name in file_names])
+    # thumbnails started on upload are renamed with their images
+    thumbnail_pipeline.wait([thumbnail_path(name) for name in image_names])
+
+    images = []
+    for name in image_names:
+        if (os.path.isfile(images_dir + name) == False):
+            continue  # download failed
+        blob = image_store.put(images_dir + name, ".jpg")
+        if (blob != name and os.path.isfile(thumbnail_path(name))):
+            if (os.path.isfile(thumbnail_path(blob))):
+                os.remove(thumbnail_path(name))
+            else:
+                os.replace(thumbnail_path(name), thumbnail_path(blob))
+        if (blob not in images):
+            images.append(blob)
+    item.Images = ",".join(images)
+
+    files = []
+    for name in file_names:
+        if (os.path.isfile(files_dir + name)):
+            files.append("{}_{}".format(file_store.put(files_dir + name), name.split("_", 1)[-1]))
         else:
-            new_image = Image.new(
-                'RGB', (thumbnail_size * (len(photos)-1), thumbnail_size), (250, 250, 250))
-            shift = 0
-            for path in photos:
-                image = Image.open(path)
-                new_image.paste(image, (shift, 0))
-                shift = shift + int(float(thumbnail_size)*0.8)
-            new_image.save(bot_item_image_path, "JPEG")
+            files.append(name)
+    item.Location = ",".join(files)
+
+
+def session_expired(user_data: dict) -> bool:
+    """Trade conversation of user_data was not touched for the session ttl, e.g. while the bot was down"""
+    return ('trade_item' in user_data and time.time() - user_data.get('trade_touched', 0) > trade_items.ttl)
+
+
+def unexpired_user_data(user_data: dict) -> dict:
+    """user_data to persist, without trade item of an expired conversation"""
+    if (session_expired(user_data)):
+        return {key: value for key, value in user_data.items() if key not in session_keys}
+    return user_data
+
+
+def restore_session(update: Update, context: CallbackContext, conversation: ConversationHandler = None):
+    """
+    Put trade item of a conversation persisted before restart back to sessions.
+    Expired one is dropped and its conversation ends, timeouts of conversations do not survive restart.
+    """
+    user = update.effective_user
+    if (user is None or 'trade_item' not in context.user_data):
+        return
+    if (session_expired(context.user_data)):
+        trade_items.pop(user.id)
+        for key in session_keys:
+            context.user_data.pop(key, None)
+        if (conversation is not None and update.effective_chat is not None):
+            key = (update.effective_chat.id, user.id)
+            if (conversation.conversations.get(key) is not None):  # loads persisted state, so it's deleted too
+                conversation.conversations.pop(key, None)
+                if (context.dispatcher.persistence is not None):
+                    context.dispatcher.persistence.update_conversation(conversation.name, key, None)
+        return
+    context.user_data['trade_touched'] = time.time()
+    if (user.id in trade_items):
+        return
+    bot_item, version = current_item.snapshot()
+    if (context.user_data.get('trade_with') != bot_item.to_string()):
+        version = -1  # my item was traded meanwhile, commit will be refused
+    trade_items.restore(user.id, context.user_data['trade_item'], version)
+
+
+def evict_sessions(context: CallbackContext = None):
+    """Forget items of abandoned trade conversations"""
+    return trade_items.evict()
+
+
+def collect_garbage(context: CallbackContext = None):
+    """Remove images, files and thumbnails not referenced by journal, current item or trades in progress"""
+    def keep_thumbnail(name):
+        return thumbnails_dir + name == bot_item_image_path or journal.referenced(name[len("t_"):])
+
+    # commits move uploads into the stores and journal them under the same lock
+    with blobs_lock:
+        items = [current_item.item] + trade_items.values()
+        blobs = refcounts(name for item in items for name in item_blobs(item))
+        thumbnails = refcounts("t_" + name for name in blobs)
+        removed = image_store.collect_garbage(blobs, C.BLOB_GC_GRACE, keep=journal.referenced)
+        removed += file_store.collect_garbage(blobs, C.BLOB_GC_GRACE, keep=journal.referenced)
+        removed += BlobStore(thumbnails_dir).collect_garbage(thumbnails, C.BLOB_GC_GRACE, keep=keep_thumbnail)
+    return removed
+
 
-        width, height = new_image.size
-        draw = ImageDraw.Draw(new_image)
-        text = "Creative Trade-in"
+def update_bot_image():
+    with bot_image_lock:
+        render_bot_image(current_item.item)
+
+
+def render_bot_image(bot_item):
+    global bot_image_key
+    global bot_image_bytes
+    global bot_image_file_id
+    key = (bot_item.Images, thumbnail_size, watermark_text)
+    if (key == bot_image_key):
+        return
+    # key is set once the image is rendered, a failed render is tried again
+    bot_image_key = None
+    bot_image_bytes = None
+    bot_image_file_id = None
+    if (bot_item.Images == ""):
+        if (os.path.isfile(bot_item_image_path)):
+            os.remove(bot_item_image_path)
+        bot_image_key = key
+        return
+
+    image_list = bot_item.Images.split(",")
+    # downloads and thumbnails are started on upload, wait for the ones still in progress
+    downloader.wait([images_dir + image_name for image_name in image_list])
+    thumbnail_pipeline.wait([thumbnail_path(image_name) for image_name in image_list])
+    photos = []
+    for image_name in image_list:
+        path = images_dir + image_name
+        pathThumbnail = thumbnail_path(image_name)
+        if (os.path.isfile(pathThumbnail) == False):
+            try:
+                image = Image.open(path)
+                image.thumbnail((thumbnail_size, thumbnail_size))
+                image.save(pathThumbnail)
+            except IOError:
+                pass
 
-        font = ImageFont.truetype('arial.ttf', 18)
-        textwidth, textheight = draw.textsize(text, font)
+        if (os.path.isfile(pathThumbnail) == False):
+            pathThumbnail = path
+        photos.append(pathThumbnail)
 
-        # calculate the x,y coordinates of the text
-        margin = 10
-        x = margin  # width - textwidth - margin
-        y = margin  # height - textheight - margin
-        # draw watermark in the left top corner
-        draw.text((x, y), text, font=font)
-        x = margin  # width - textwidth - margin
-        y = height - textheight - margin
-        # draw watermark in the bottom left corner
-        draw.text((x, y), text, font=font)
-        new_image.save(bot_item_image_path)
+    if (len(photos) == 1):
+        new_image = Image.open(photos[0]).convert('RGB')
+    else:
+        new_image = Image.new(
+            'RGB', (thumbnail_size * (len(photos)-1), thumbnail_size), (250, 250, 250))
+        shift = 0
+        for path in photos:
+            with Image.open(path) as image:
+                new_image.paste(image, (shift, 0))
+            shift = shift + int(float(thumbnail_size)*0.8)
+
+    width, height = new_image.size
+    draw = ImageDraw.Draw(new_image)
+    left, top, right, bottom = draw.textbbox((0, 0), watermark_text, font=watermark_font)
+    textheight = bottom - top
+
+    # calculate the x,y coordinates of the text
+    margin = 10
+    x = margin  # width - textwidth - margin
+    y = margin  # height - textheight - margin
+    # draw watermark in the left top corner
+    draw.text((x, y), watermark_text, font=watermark_font)
+    x = margin  # width - textwidth - margin
+    y = height - textheight - margin
+    # draw watermark in the bottom left corner
+    draw.text((x, y), watermark_text, font=watermark_font)
+
+    # encode once, the same bytes are saved and served by /start
+    buffer = BytesIO()
+    new_image.save(buffer, "JPEG")
+    bot_image_bytes = buffer.getvalue()
+    with open(bot_item_image_path, 'wb') as f:
+        f.write(bot_image_bytes)
+    bot_image_key = key
 
 
 def start_command(update: Update, context: CallbackContext):
-    global bot_item
-    # reset user's item
-    if (os.path.isfile(bot_item_image_path) == False and bot_item.Images != ""):
-        update_bot_image()
+    global bot_image_file_id
+    bot_item = current_item.item
+    update_bot_image()
     response = "Hi {}! Here is my item \"{}\".\nLet's trade-in with your item valued higher than ${}.\nType /trade to initiate trad-in process...".format(
         update.message.from_user.first_name, bot_item.Item, bot_item.Value)
     update.message.reply_text(response)
-    if (os.path.isfile(bot_item_image_path)):
-        context.bot.send_photo(
-            chat_id=update.message.chat_id, photo=open(bot_item_image_path, 'rb'))
+    if (bot_image_file_id is not None):
+        context.bot.send_photo(chat_id=update.message.chat_id, photo=bot_image_file_id)
+    elif (bot_image_bytes is not None):
+        message = context.bot.send_photo(chat_id=update.message.chat_id, photo=bot_image_bytes)
+        bot_image_file_id = message.photo[-1].file_id
 
 def start_conv(update: Update, context: CallbackContext) -> int:
     """Starts the conversation and asks the user about the item."""
     global trade_items
-    trade_items[update.message.from_user.id] = T.TradeItem("")
+    bot_item, version = current_item.snapshot()
+    # kept in persisted user_data as well, to continue the conversation after restart
+    context.user_data['trade_item'] = trade_items.start(update.message.from_user.id, version)
+    context.user_data['trade_with'] = bot_item.to_string()
+    context.user_data['trade_touched'] = time.time()
     reply_keyboard = [['File', 'Coupon', 'Other']]
     update.message.reply_text(
         'Please answer the following questions about your item.\nSend /stop to cancel conversation.\nWhat is type of your item?',
@@ -156,8 +320,8 @@ def type_conv(update: Update, context: CallbackContext) -> int:
 
 
 def item_conv(update: Update, context: CallbackContext) -> int:
-    #global bot_item
     global trade_items
+    bot_item = current_item.item
     trade_items[update.message.from_user.id].Item = update.message.text
     update.message.reply_text(
         'Please tell me the value of your item named "{}".\nIt must be higher than my item value ${}!'.format(update.message.text, bot_item.Value))
@@ -165,8 +329,8 @@ def item_conv(update: Update, context: CallbackContext) -> int:
 
 
 def value_conv(update: Update, context: CallbackContext) -> int:
-    #global bot_item
     global trade_items
+    bot_item = current_item.item
     try:
         #https://regex101.com/r/aW3pR4/25
         r = re.compile(r"^(\d+[.,]?[\d*]?)$")
@@ -188,18 +352,23 @@ def value_conv(update: Update, context: CallbackContext) -> int:
 
 
 def photo_conv(update: Update, context: CallbackContext) -> int:
-    """Stores the photo and asks for a file."""
+    """Stores the photo and asks for a file. Photos of one album come as separate messages."""
     global trade_items
-    #https://api.telegram.org/file/bot<token>/<file_path>, where <file_path> is 
-    trade_items[update.message.from_user.id].Images = ""
-    for photo in update.message.photo:
-        #ignore thumbnails and small files sizes
-        if (photo.height> 1000 and photo.file_size < 5000000):
-            file = photo.get_file()
-            fileName = "{}_{}.jpg".format(update.message.from_user.id, file.file_id) #file_name.replace(",","").replace("|","")
-            file.download(images_dir + fileName)
-            trade_items[update.message.from_user.id].Images += "," + fileName
-    trade_items[update.message.from_user.id].Images = trade_items[update.message.from_user.id].Images.strip(',')
+    #only the largest resolution of the photo is downloaded, in background
+    photo = best_photo_size(update.message.photo, C.MAX_PHOTO_BYTES)
+    if (photo is None):
+        update.message.reply_text('Sorry, the photo is larger than 5MB. Please send smaller one, or type /skip.')
+        return None
+    fileName = "{}_{}.jpg".format(update.message.from_user.id, photo.file_unique_id)
+    downloader.submit(photo, images_dir + fileName, C.MAX_PHOTO_BYTES,
+        then=lambda path: thumbnail_pipeline.submit(path, thumbnail_path(fileName), thumbnail_size))
+    trade_items[update.message.from_user.id].Images = (trade_items[update.message.from_user.id].Images + "," + fileName).strip(',')
+
+    #next photos of the same album are stored silently, conversation stays in current state
+    media_group_id = update.message.media_group_id
+    if (media_group_id is not None and context.user_data.get('media_group_id') == media_group_id):
+        return None
+    context.user_data['media_group_id'] = media_group_id
 
     if (trade_items[update.message.from_user.id].Type == "File"):
         update.message.reply_text(
@@ -228,11 +397,13 @@ def document_conv(update: Update, context: CallbackContext) -> int:
     global trade_items
     """Stores the file and asks for a location."""
     doc = update.message.document
-    if (doc.file_size < 10000000):
-        fileName = "{}_{}".format(update.message.from_user.id, doc.file_name.replace(",",".").replace("|","."))
-        file = doc.get_file()
-        file.download(files_dir + fileName)
+    fileName = "{}_{}".format(update.message.from_user.id, doc.file_name.replace(",",".").replace("|","."))
+    try:
+        downloader.submit(doc, files_dir + fileName, C.MAX_FILE_BYTES)
         trade_items[update.message.from_user.id].Location += "," + fileName
+    except FileTooLarge:
+        update.message.reply_text('Sorry, the file is larger than 10MB. Please send smaller one, or type /skip.')
+        return None
     trade_items[update.message.from_user.id].Location = trade_items[update.message.from_user.id].Location.strip(',')
 
     update.message.reply_text('At last, describe your item.')
@@ -273,31 +444,34 @@ def description_conv(update: Update, context: CallbackContext) -> int:
     return T.Q8
 
 def commit_conv(update: Update, context: CallbackContext):
-    global bot_item
     global trade_items
 
     if (update.message.text == "Confirm"):
         response = "Done!\n"
-        if update.message.from_user.id in trade_items:
-            userItem = trade_items[update.message.from_user.id]
+        user_id = update.message.from_user.id
+        if user_id in trade_items:
+            expected_version = trade_items.version(user_id)
+            userItem = trade_items.pop(user_id)
+            context.user_data.pop('trade_item', None)
+
+            new_item = T.TradeItem(userItem.to_string())
+            new_item.Owner = "{}_{}".format(update.message.from_user.first_name, user_id)
+            with blobs_lock:  # garbage collection does not see stored uploads before they are journaled
+                store_uploads(new_item)
+                # swap only if nobody traded my item since user has started, journal is written under the same lock
+                bot_item = current_item.compare_and_swap(expected_version, new_item, on_swap=write_journal)
+            if (bot_item is None):
+                update.message.reply_text(
+                    "Sorry, my item has just been traded-in with someone else. Type /start to see my new item.",
+                    reply_markup=ReplyKeyboardRemove())
+                return ConversationHandler.END
+            update_bot_image()
 
             reply_keyboard=[]
             if ((bot_item.Type == "File") and (bot_item.Location != "")):
-                files_list = bot_item.Location.split(",")
-                reply_keyboard = [files_list]
-
-            bot_item.Owner = "{}_{}".format(update.message.from_user.first_name, update.message.from_user.id)
-            bot_item.Type = userItem.Type
-            bot_item.Item = userItem.Item
-            bot_item.Date = userItem.Date
-            bot_item.Value = userItem.Value
-            bot_item.Location = userItem.Location
-            bot_item.Description = userItem.Description
-            bot_item.Images = userItem.Images
-            write_journal()
-            update_bot_image()
-            # reset user's item
-            userItem = T.TradeItem("")
+                # buttons show file names, entries are prefixed by content digest
+                context.user_data['download_files'] = {entry.split("_", 1)[-1]: entry for entry in bot_item.Location.split(",")}
+                reply_keyboard = [list(context.user_data['download_files'].keys())]
 
             if (len(reply_keyboard)>0):
                 update.message.reply_text(
@@ -318,20 +492,22 @@ def commit_conv(update: Update, context: CallbackContext):
 #ensure that docs you send are below 20 MB as per https://core.telegram.org/bots/api#sending-files
 #update.message.reply_document(update.effective_message.chat_id, bot_item.Location)
 def download_conv(update: Update, context: CallbackContext):
-    global bot_item
-    global trade_items
     #ensure that docs you send are below 20 MB as per https://core.telegram.org/bots/api#sending-files
     #update.message.reply_document(update.effective_message.chat_id, bot_item.Location)
-    file_path = update.message.text
-    if (os.path.isfile(files_dir + file_path) == True):
+    entry = context.user_data.get('download_files', {}).get(update.message.text, update.message.text)
+    file_path = file_blob_path(entry)
+    if (os.path.isfile(file_path) == True):
         update.message.reply_text("Please wait arrival...", reply_markup=ReplyKeyboardRemove())
-        context.bot.sendDocument(chat_id=update.message.chat_id, document=open(files_dir + file_path, 'rb'))
+        with open(file_path, 'rb') as document:
+            context.bot.sendDocument(chat_id=update.message.chat_id, document=document, filename=entry.split("_", 1)[-1])
     return ConversationHandler.END
 
 
 def stop_conv(update: Update, context: CallbackContext) -> int:
     """Ends the conversation."""
     user = update.message.from_user
+    trade_items.pop(user.id)
+    context.user_data.pop('trade_item', None)
     #logger.info("User %s canceled the conversation.", user.first_name)
     update.message.reply_text(
         'Bye! I hope we can trade-in again some day.', reply_markup=ReplyKeyboardRemove()
@@ -1,19 +1,19 @@
-from bot3 import EDITING
-import os
 import logging
-import pymongo
 from pymongo.message import query
 from bson.objectid import ObjectId
 import requests
-import json
-from ibm_watson import SpeechToTextV1
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+import speech
 
 from typing import Dict
 #from datetime import datetime
 import constants as C
 #from constants import TELEGRAM_TOKEN, HEROKU_APP_NAME, HEROKU_PORT
-#import database as DB
+import database as DB
+import metrics
+import outbound
+import runtime
+from persistence import BatchedPersistence, MongoStore
+from telegram.utils import helpers
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton
 #from telegram.ext import *
 from telegram.ext import (
@@ -46,14 +46,12 @@ class Bot:
 
     # instance members
     def __init__(self):
-        myclient = pymongo.MongoClient(C.MONGODB_CONNECTION_URL)
-        self.botDB = myclient["botDB"]
-        authenticator = IAMAuthenticator(C.IBM_KEY)
-        self.speech_to_text = SpeechToTextV1(
-            authenticator=authenticator
-        )
-        self.speech_to_text.set_service_url(C.IBM_SERVICE_URL)
-        self.speech_to_text.set_disable_ssl_verification(True)
+        self.botDB = DB.get_db()
+        DB.ensure_indexes(self.botDB)
+        #items saved with text Value only are not found by search filtering on value_cents
+        DB.migrate_values(self.botDB)
+        DB.migrate_categories(self.botDB)
+        self.speech = speech.SpeechQueue(speech.create_recognizer())
 
         # R.read_journal()
 
@@ -101,36 +99,30 @@ class Bot:
 
     def voice_choice(self, update: Update, context: CallbackContext):
         """
-        bot sends audio to IBM Speech to Text: 
-        https://cloud.ibm.com/catalog/services/speech-to-text
-        https://cloud.ibm.com/apidocs/speech-to-text?code=python#recognize
+        voice is recognized in background by speech queue, user gets the transcript when it is ready.
+        If user was asked for a category value, the transcript becomes that value.
         """
-        # print(update.message.voice)
-        #voice_content = update.message.voice.get_file()
-        # context.bot.get_file(update.message.voice.file_id)
-        voice_content = update.message.voice.get_file()
-
-        speech_recognition_results = self.speech_to_text.recognize(
-            audio=voice_content.download_as_bytearray(),
-            content_type='audio/flac',
-            word_alternatives_threshold=0.9,
-            #keywords=['colorado', 'tornado', 'tornadoes'],
-            keywords_threshold=0.5
-        ).get_result()
-        print(json.dumps(speech_recognition_results, indent=2))
-
-        if speech_recognition_results.status_code != 200 or not speech_recognition_results:
-            update.message.reply_text("Could not hear you well!",
+        user_data = context.user_data
+
+        def transcribed(transcript):
+            if transcript and 'choice' in user_data:
+                user_data[user_data['choice']] = transcript
+                del user_data['choice']
+            if not transcript:
+                update.message.reply_text("Could not hear you well!",
+                                          reply_markup=self.markup,
+                                          )
+            else:
+                update.message.reply_text(
+                    "Got your voice! Just so you know, this is what you already told me:"
+                    f"{Bot.facts_to_str(user_data)}{transcript}\nYou can tell me more, or change your opinion",
+                    reply_markup=self.markup,
+                )
+
+        if not self.speech.submit(update.message.voice, transcribed):
+            update.message.reply_text("I am too busy to listen now, please type it",
                                       reply_markup=self.markup,
                                       )
-        else:
-            text = json.dumps(speech_recognition_results, indent=2)
-            update.message.reply_text(
-                "Got your voice! Just so you know, this is what you already told me:"
-                f"{text} You can tell me more, or change your opinion",
-                reply_markup=self.markup,
-            )
-
         return Bot.CHOOSING
 
     def document_choice(self, update: Update, context: CallbackContext):
@@ -210,6 +202,7 @@ class Bot:
             del user_data['choice']
 
         user_data['owner_id'] = update.message.from_user.id
+        user_data['categories'] = DB.categories_text(user_data)
         items_coll = self.botDB["items"]
         #item = { "name": "John", "address": "Highway 37" }
         x = items_coll.insert_one(user_data)
@@ -275,6 +268,7 @@ class Bot:
         if '_id' in user_data:
             del user_data['_id']
         #print(user_data)
+        user_data['categories'] = DB.categories_text(user_data)  # user_data holds all fields of the item
         edited_item = self.botDB["items"].find_one_and_update(filter={"_id": ObjectId(_id), "owner_id": update.message.from_user.id}, 
             update={"$set": user_data}, upsert=True, return_document=True)
         if (bool(edited_item)):
@@ -350,7 +344,7 @@ class Bot:
 
             replytext = ""
             for key, value in item.items():
-                if (key not in ['_id', 'owner_id']):
+                if (key not in ['_id', 'owner_id', 'value_cents', 'categories']):
                     #print("key:{}, value {}".format(key, value))
                     if (key == 'Image_thumbnail'):
                         context.bot.send_photo(update.message.chat_id, item['Image_thumbnail'])
@@ -368,8 +362,35 @@ class Bot:
 
 
     def search_command(self, update: Update, context: CallbackContext):
-        update.message.reply_text("Ok! Let's see what I have based on your request: {}".format(
-            context.args))
+        """Items of other owners matching words of the request, best matches first"""
+        text = " ".join(context.args)
+        if (text == ""):
+            update.message.reply_text("Please type what you are looking for after the command, e.g. /search bike")
+            return
+        condition = DB.text_search_condition(text, {"owner_id": {"$ne": update.message.from_user.id}})
+        items = self.botDB["items"].find(condition, dict(DB.TEXT_SCORE, Name=True, Value=True, Description=True)) \
+            .sort(DB.TEXT_SORT).limit(20)  # one message
+        replytext = "Ok\\! Let's see what I have based on your request: `{}`\n".format(helpers.escape_markdown(text, version=2))
+        found = 0
+        skipped = 0
+        for item in items:
+            found += 1
+            description = str(item.get('Description', ''))
+            if (len(description) > C.SEARCH_DESCRIPTION_LENGTH):
+                description = description[:C.SEARCH_DESCRIPTION_LENGTH] + "…"
+            line = "\n*{}:* `{}` {}".format(helpers.escape_markdown(str(item.get('Name', '')), version=2),
+                helpers.escape_markdown(str(item.get('Value', '')), version=2),
+                helpers.escape_markdown(description, version=2))
+            #matches which do not fit into one message are counted, room is left for the note
+            if (skipped > 0 or len(replytext) + len(line) > outbound.MAX_MESSAGE_LENGTH - 100):
+                skipped += 1
+            else:
+                replytext += line
+        if (found == 0):
+            replytext += "Nothing found"
+        elif (skipped > 0):
+            replytext += "\n\n{} more found, please type more words to narrow the search".format(skipped)
+        update.message.reply_text(replytext, parse_mode='MarkdownV2')
 
     def callback_query_handler(self, update: Update, context: CallbackContext):
         #print("callback_query_handler: {}".format(update.callback_query.data))
@@ -387,12 +408,7 @@ class Bot:
         print('TBD!go next page')
         return ConversationHandler.END
 
-    def run(self):
-        # Create the Updater and pass it your bot's token.
-        #persistence = PicklePersistence(filename='conversationbot')
-        # , persistence=persistence)
-        updater = Updater(C.TELEGRAM_TOKEN, use_context=True)
-        dispatcher = updater.dispatcher
+    def add_handlers(self, dispatcher) -> None:
         dispatcher.add_handler(CommandHandler("start", self.start_command))
         dispatcher.add_handler(CommandHandler(
             "search", self.search_command, pass_args=True))
@@ -405,6 +421,8 @@ class Bot:
 
         #Create item conversation handler
         create_handler = ConversationHandler(
+            name="create",
+            persistent=True,
             entry_points=[CommandHandler('create', self.create_command)],
             states={
                 Bot.CHOOSING: [
@@ -430,7 +448,8 @@ class Bot:
                         Filters.text & ~(Filters.command |
                                          Filters.regex('^Done$')),
                         self.received_information,
-                    )
+                    ),
+                    MessageHandler(Filters.voice, self.voice_choice),
                 ],
             },
             fallbacks=[MessageHandler(
@@ -440,6 +459,8 @@ class Bot:
         dispatcher.add_handler(create_handler)
         
         edit_handler = ConversationHandler(
+            name="edit",
+            persistent=True,
             entry_points=[CommandHandler('edit', self.edit_command, pass_args=True)],
             states={
                 Bot.CHOOSING: [
@@ -465,7 +486,8 @@ class Bot:
                         Filters.text & ~(Filters.command |
                                          Filters.regex('^Done$')),
                         self.received_information,
-                    )
+                    ),
+                    MessageHandler(Filters.voice, self.voice_choice),
                 ],
             },
             fallbacks=[MessageHandler(Filters.regex('^Done$'), self.edit_confirm)],
@@ -474,6 +496,8 @@ class Bot:
         dispatcher.add_handler(edit_handler)
 
         delete_handler = ConversationHandler(
+            name="delete",
+            persistent=True,
             entry_points=[CommandHandler('delete', self.delete_command, pass_args=True)],
             states={
                 Bot.CHOOSING: [MessageHandler(Filters.regex('^(Confirm|Cancel)$'), self.delete_confirm)],
@@ -490,23 +514,22 @@ class Bot:
 
         dispatcher.add_error_handler(self.error)
 
-        # Run bot
-        if C.HEROKU_APP_NAME == "":  # pooling mode
-            logger.info(
-                "Can't detect 'HEROKU_APP_NAME' env. Running bot in pooling mode.")
-            #print("Note: this is not a great way to deploy the bot in Heroku.")
-            updater.start_polling(1)
-        else:  # webhook mode
-            #print(f"Running bot in webhook mode. Make sure that this url is correct: https://{C.HEROKU_APP_NAME}.herokuapp.com/")
-            PORT = int(os.environ.get('PORT', C.HEROKU_PORT))
-            updater.start_webhook(
-                listen="0.0.0.0",
-                port=PORT,
-                url_path=C.TELEGRAM_TOKEN,
-                webhook_url=f"https://{C.HEROKU_APP_NAME}.herokuapp.com/{C.TELEGRAM_TOKEN}"
-            )
+    def create_updater(self) -> Updater:
+        """Updater with persistence, handlers and jobs of the bot, not started yet"""
+        persistence = BatchedPersistence(MongoStore(self.botDB["bot2_persistence"]))
+        updater = runtime.new_updater(persistence)
+        self.add_handlers(updater.dispatcher)
+        updater.job_queue.run_repeating(metrics.log_snapshot, interval=C.METRICS_LOG_INTERVAL, first=C.METRICS_LOG_INTERVAL)
+        updater.job_queue.run_repeating(persistence.flush_job, interval=C.PERSISTENCE_FLUSH_INTERVAL)
+        return updater
+
+    def run(self):
+        runtime.run(self.create_updater, create_updater)
+
 
-        updater.idle()
+def create_updater() -> Updater:
+    """Bot of a webhook worker process"""
+    return Bot().create_updater()
 
 
 if __name__ == '__main__':
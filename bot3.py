@@ -14,19 +14,26 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 import sys
-import os
+import time
 import logging
-import pymongo
 from pymongo.message import query
 from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
 import constants as C
-from datetime import datetime
-import json
-from ibm_watson import SpeechToTextV1
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+import database as DB
+from repositories import ItemRepository, TransactionRepository
+import repositories
+import pages
+from profiles import ProfileCache, chat_display_name
+from media import MediaRenderer
+import metrics
+import speech
+import runtime
+from persistence import BatchedPersistence, MongoStore
 
 import logging
-from typing import Tuple, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Dict, Any, List
 
 from telegram import (InlineKeyboardMarkup, InlineKeyboardButton, Update, chat)
 from telegram.ext import (
@@ -38,6 +45,7 @@ from telegram.ext import (
     CallbackQueryHandler,
     CallbackContext,
 )
+from telegram.error import TelegramError
 from telegram.utils import helpers
 #from telegram.utils.helpers import escape_markdown, helpers
 
@@ -69,12 +77,18 @@ END = ConversationHandler.END
     DOCUMENT,
     VOICE
 ) = map(chr, range(18, 26))
+# Paging of trades history
+HISTORY_PAGE = chr(26)
+# Ranked results of typed search query
+TEXT_QUERY = chr(27)
+
+PAGE_SIZE = 5
 
 class Bot:
     # static helpers
     def facts_to_str(user_data: Dict[str, str]) -> str:
         """Helper function for formatting the gathered user info."""
-        excludeKeys = {PREV_PAGE, NEXT_PAGE, PAGE_MASSAGES, PAGE_ITEMS, TRADING, REPLYING, CALLING, VOICE, '_id', 'chat_id', 'Images', 'Files'}
+        excludeKeys = {PREV_PAGE, NEXT_PAGE, HISTORY_PAGE, TEXT_QUERY, PAGE_MASSAGES, PAGE_ITEMS, TRADING, REPLYING, CALLING, VOICE, '_id', 'chat_id', 'owner_name', 'preowned_by', 'value_cents', 'Images', 'Files'}
         #translation_table = dict.fromkeys(map(ord, '!$*-`_()[].'), "\\")
         #value.translate(translation_table)
         facts = [f'*{key}*: `{helpers.escape_markdown(str(value), version=2)}`' for key, value in user_data.items() if key not in excludeKeys]
@@ -84,50 +98,47 @@ class Bot:
 
     def facts_to_save(user_data: Dict[str, Any]) -> Dict[str, Any]:
         """Helper function for saving in database."""
-        excludeKeys = {PREV_PAGE, NEXT_PAGE, PAGE_MASSAGES, PAGE_ITEMS, TRADING, REPLYING, CALLING, VOICE, '_id'}
+        excludeKeys = {PREV_PAGE, NEXT_PAGE, HISTORY_PAGE, TEXT_QUERY, PAGE_MASSAGES, PAGE_ITEMS, TRADING, REPLYING, CALLING, VOICE, '_id', 'preowned_by', 'version', 'value_cents'}
         return {x: user_data[x] for x in user_data if x not in excludeKeys}
 
-    def get_value_from_string(data):
-        #int(''.join(c for c in s if c.isdigit()))
-        #import re
-        #re.findall("\d+\.\d+", "Current Level: 13.4 db.")
-        value = 0.0
-        if data is None:
-            return value
-        try:
-            value = float(str(data).replace(',', '').replace('$', '').strip(' '))
-        except:
-            pass
-        return value
-
     # instance members
-    def __init__(self):
-        self.myclient = pymongo.MongoClient(C.MONGODB_CONNECTION_URL)
-        self.botDB = self.myclient["botDB"]
-        authenticator = IAMAuthenticator(C.IBM_KEY)
-        self.speech_to_text = SpeechToTextV1(authenticator=authenticator)
-        self.speech_to_text.set_service_url(C.IBM_SERVICE_URL)
-        #InsecureRequestWarning: Unverified HTTPS request is being made to host 'api.au-syd.speech-to-text.watson.cloud.ibm.com'. Adding certificate verification is strongly advised. See: https://urllib3.readthedocs.io/en/1.2
-        #self.speech_to_text.set_disable_ssl_verification(True)
-
-    def remove_page_messages(self, update: Update, context: CallbackContext):
-        #print("remove_page_messages")
+    def __init__(self, db=None, speech_backends: str = C.SPEECH_BACKENDS):
+        """Bot on database db, botDB of settings by default"""
+        self.botDB = DB.get_db() if db is None else db
+        self.myclient = self.botDB.client
+        DB.ensure_indexes(self.botDB)
+        #items saved with text Value only are not found by search filtering on value_cents
+        DB.migrate_values(self.botDB)
+        DB.migrate_categories(self.botDB)
+        self.items = ItemRepository(self.botDB)
+        self.transactions = TransactionRepository(self.botDB)
+        self.speech = speech.SpeechQueue(speech.create_recognizer(speech_backends, C.SPEECH_KEYWORDS))
+        self.profiles = ProfileCache()
+        self.media = MediaRenderer()
+        self.cleanup = ThreadPoolExecutor(max_workers=C.CLEANUP_WORKERS, thread_name_prefix='cleanup')
+        self.queries = ThreadPoolExecutor(max_workers=C.QUERY_WORKERS, thread_name_prefix='query')
+
+    def delete_message(self, bot, chat_id, message_id):
+        try:
+            bot.delete_message(chat_id=chat_id, message_id=message_id)
+            metrics.increment('delete_message.ok')
+        except TelegramError as e:
+            metrics.increment('delete_message.failed')
+            logger.debug(f"delete_message {message_id} in chat {chat_id} failed: {e}")
+
+    def remove_page_messages(self, update: Update, context: CallbackContext) -> List[int]:
+        """Delete tracked messages of the previous page in background, handler does not wait for it, returns their ids"""
         try:
             _chat_id = update.callback_query.message.chat_id
         except:
             _chat_id = update.message.chat_id
 
-        #print("remove_page_messages: 2")
         chat_data = context.chat_data
-        if PAGE_MASSAGES in chat_data and _chat_id:
-            #print("remove_page_messages: 3")
-            for _id in chat_data[PAGE_MASSAGES]:
-                try:
-                    context.bot.delete_message(chat_id=_chat_id, message_id=_id)
-                except:
-                    pass
-        chat_data[PAGE_MASSAGES] = []
-        #print("remove_page_messages: 4")
+        message_ids = pages.messages_of(chat_data, PAGE_MASSAGES).drain()
+        if _chat_id:
+            for _id in message_ids:
+                self.cleanup.submit(self.delete_message, context.bot, _chat_id, _id)
+        return message_ids
 
     # Top level conversation callbacks
     def start(self, update: Update, context: CallbackContext) -> str:
@@ -169,15 +180,7 @@ class Bot:
         return SELECTING_ACTION
 
     def get_user_info(self, chat_id, context: CallbackContext):
-        _chat = context.bot.get_chat(chat_id=chat_id)
-        result = ""
-        if (_chat.username is not None and _chat.username != "None"):
-            result = _chat.username
-        elif (_chat.first_name is not None and _chat.first_name != "None"):
-            result = f"{_chat.first_name} {_chat.last_name}"
-        else:
-            result = str(chat_id)
-        return result
+        return self.profiles.resolve(context.bot, [chat_id])[int(chat_id)]
 
     def history(self, update: Update, context: CallbackContext) -> str:
         #print("history of otcoming trades")
@@ -186,32 +189,50 @@ class Bot:
             chat_id = update.callback_query.message.chat_id
         except:
             chat_id = update.message.chat_id
-        count = self.botDB["transactions"].count_documents( { "from_chat_id" : chat_id } )
-        trans = self.botDB["transactions"].find( { "from_chat_id" : chat_id } )
         chat_data = context.chat_data
         user_data = context.user_data
 
+        offset = int(user_data.get(HISTORY_PAGE, 0))
+        if (update.callback_query.data == PREV_PAGE):
+            offset = max(offset - PAGE_SIZE, 0)
+        elif (update.callback_query.data == NEXT_PAGE):
+            offset = offset + PAGE_SIZE
+        else:
+            offset = 0
+        user_data[HISTORY_PAGE] = offset
+        count, trans = self.transactions.timeline(chat_id, offset, PAGE_SIZE)
+
         #print(f"count:{count}, offset:{offset}")
         buttons = []
-        # if (offset > 0 and offset >= PAGE_SIZE):
-        #     buttons.append(InlineKeyboardButton(text='⬅️Prev page', callback_data=str(PREV_PAGE)))
-        # if (offset + PAGE_SIZE < count):
-        #     buttons.append(InlineKeyboardButton(text='➡️Next page', callback_data=str(NEXT_PAGE)))
+        if (offset > 0 and offset >= PAGE_SIZE):
+            buttons.append(InlineKeyboardButton(text='⬅️Prev page', callback_data=str(PREV_PAGE)))
+        if (offset + PAGE_SIZE < count):
+            buttons.append(InlineKeyboardButton(text='➡️Next page', callback_data=str(NEXT_PAGE)))
         buttons.append(InlineKeyboardButton(text='🔙Back to main menu', callback_data=str(END)))
         keyboard = InlineKeyboardMarkup([buttons])
 
         if bool(update.callback_query):
             _text = (f"{count} historical trade-in(s) found")
+            if (count > PAGE_SIZE):
+                _text += f". Page {int(offset/PAGE_SIZE) + 1} of {(count + PAGE_SIZE - 1) // PAGE_SIZE}"
+
             if (_text != update.callback_query.message.text):
                 update.callback_query.answer()
                 update.callback_query.edit_message_text(text=_text, reply_markup=keyboard)
-        transNo = 0
+        #resolve all owners of the page at once, names saved with transaction do not need a lookup
+        owners = self.profiles.resolve(context.bot,
+            [tran['from_chat_id'] for tran in trans if not tran.get('from_name')] +
+            [tran['to_chat_id'] for tran in trans if not tran.get('to_name')])
+        transNo = offset
+        albums = []
         for tran in trans:
-            item = self.botDB["items"].find_one({"_id": ObjectId(tran['item_id'])})
+            item = tran.get('item') or {}
             _text = ""
-            _image_ids = ""
+            _image_ids = str(item.get('Images', ""))
             transNo +=1
-            facts={'From': self.get_user_info(tran['from_chat_id'], context), 'To': self.get_user_info(tran['to_chat_id'], context), 'Trans No': str(transNo), 'Trade Date': str(tran['trans_date'])[0:16]} #"%d/%m/%y %H:%M"
+            facts={'From': tran.get('from_name') or owners[tran['from_chat_id']]
+                , 'To': tran.get('to_name') or owners[tran['to_chat_id']]
+                , 'Trans No': str(transNo), 'Trade Date': str(tran['trans_date'])[0:16]} #"%d/%m/%y %H:%M"
             #facts["To owner"] = str(tran['to_chat_id'])
             for key, value in item.items():
                 facts[key] = str(value)
@@ -223,84 +244,163 @@ class Bot:
                 #    ]])
                 #, reply_to_message_id=update.callback_query.message.message_id
                 , parse_mode='MarkdownV2') #ParseMode.MARKDOWN_V2
-            chat_data[PAGE_MASSAGES].append(item_message.message_id)
-            #context.bot.send_media_group(chat_id=get_chat_id(update, context), media=list)
-            if (_image_ids != ""):
-               for image_id in _image_ids.split('|'):
-                   if (image_id != ""):
-                       try:
-                           image_message = context.bot.send_photo(chat_id=update.callback_query.message.chat_id
-                               , reply_to_message_id=item_message.message_id
-                               , photo=image_id
-                               , caption="Attached image")
-                           chat_data[PAGE_MASSAGES].append(image_message.message_id)
-                       except:
-                           pass
+            pages.messages_of(chat_data, PAGE_MASSAGES).append(item_message.message_id)
+            albums.append((_image_ids, item_message.message_id))
 
+        #photos of all items of the page are sent concurrently as albums
+        pages.messages_of(chat_data, PAGE_MASSAGES).extend(self.media.render(context.bot, update.callback_query.message.chat_id, albums))
         return TRACKING #SEARCHING is ok as well
 
-    #not implemented yet
-    def search_text_filter(self, update: Update, context: CallbackContext) -> str:
-        chat_data = context.chat_data
-        user_data = context.user_data
-        return SEARCHING
+    def search_page(self, condition, cursor: Dict[str, Any], direction) -> Tuple[list, bool, bool]:
+        """
+        Keyset pagination by _id: next page continues after the last shown _id, previous page ends before the first one.
+        One extra document is read to know whether there is one more page in that direction.
+        Updates cursor in place and returns items of the page in _id order, has previous page, has next page.
+        """
+        page = cursor['page']
+        if (direction == NEXT_PAGE and cursor['last'] is not None):
+            items = self.items.page(condition, PAGE_SIZE + 1, after=cursor['last'])
+            has_prev, has_next = True, len(items) > PAGE_SIZE
+            items = items[:PAGE_SIZE]
+            page += 1
+        elif (direction == PREV_PAGE and cursor['first'] is not None):
+            items = self.items.page(condition, PAGE_SIZE + 1, before=cursor['first'])
+            has_prev, has_next = len(items) > PAGE_SIZE, True
+            items = items[:PAGE_SIZE][::-1]
+            page = max(page - 1, 0) if has_prev else 0
+        else:
+            items = []
+
+        if (len(items) == 0): #first page, or items in that direction were traded away meanwhile
+            items = self.items.page(condition, PAGE_SIZE + 1)
+            has_prev, has_next = False, len(items) > PAGE_SIZE
+            items = items[:PAGE_SIZE]
+            page = 0
+
+        cursor['page'] = page
+        cursor['first'] = items[0]['_id'] if items else None
+        cursor['last'] = items[-1]['_id'] if items else None
+        return items, has_prev, has_next
+
+    def affordable_condition(self, chat_id, cursor: Dict[str, Any]):
+        """
+        Search condition of the chat, limited by value of its item and without items it owned before,
+        both are looked up once per search and its pages
+        """
+        if ('max_value' not in cursor):
+            cursor['max_value'] = None
+            #only items the user can afford, trade_commit rejects more valuable ones anyway
+            item = self.items.by_owner(chat_id, {"Value": True, "value_cents": True})
+            if (item is not None):
+                cursor['max_value'] = DB.item_value_cents(item)
+            cursor['preowned'] = self.items.preowned_ids(chat_id)
+        return DB.search_condition(chat_id, cursor['max_value'], cursor.get('preowned'))
 
     def search(self, update: Update, context: CallbackContext) -> str:
         #print("search")
-        self.remove_page_messages(update,  context)
-        chat_data = context.chat_data
+        removed = self.remove_page_messages(update,  context)
         user_data = context.user_data
-        PAGE_SIZE = 5
-        try:
-            chat_id = update.callback_query.message.chat_id
-        except:
-            chat_id = update.message.chat_id
-
-        trans = self.botDB["transactions"].find( { "from_chat_id" : chat_id } , projection = { "item_id" : True } )
-        exsclude_preowned_items = [None]
-        for tran in trans:
-            exsclude_preowned_items.append(tran['item_id'])
-
-        condition = {"$and": [
-                { "chat_id" : { "$nin": [None, chat_id] } },    #exclude currently owned item
-                { "_id" : { "$nin": exsclude_preowned_items } } #exclude preowned items
-            ]
-        }
+        chat_id = update.effective_chat.id
+
+        #page cursor, new search starts from the first page
+        cursor = user_data.get(PREV_PAGE)
+        if (not isinstance(cursor, dict) or update.callback_query.data == SEARCHING):
+            cursor = {'page': 0, 'first': None, 'last': None, 'count': None, 'counted': 0.0}
+            user_data.pop(TEXT_QUERY, None)
+        user_data[PREV_PAGE] = cursor
+        #paging through results of typed query
+        if (TEXT_QUERY in user_data):
+            #header of typed query is a page message, it's just being deleted and is sent again
+            new_header = update.callback_query.message.message_id in removed
+            return self.text_search_page(update, context, update.callback_query.data, new_header)
+
+        condition = self.affordable_condition(chat_id, cursor)
         #DEBIG condition = { "_id" : { "$ne": None } }
-        count = self.botDB["items"].count_documents(condition)
+        #total is only informative, it is recounted once in a while but not on every page, concurrently with the page query
+        count = None
+        if (cursor['count'] is None or time.monotonic() - cursor['counted'] > C.SEARCH_COUNT_TTL):
+            count = self.queries.submit(self.items.count, condition)
+        items, has_prev, has_next = self.search_page(condition, cursor, update.callback_query.data)
+        if (count is not None):
+            cursor['count'] = count.result()
+            cursor['counted'] = time.monotonic()
+        count = max(cursor['count'], cursor['page'] * PAGE_SIZE + len(items))
+
+        #print(f"count:{count}, page:{cursor['page']}")
+        return self.show_search_page(update, context, items, cursor['page'], count, has_prev, has_next,
+            "item(s) found in total.") #You can type to search by text
 
-        if PREV_PAGE not in user_data:
-            user_data[PREV_PAGE] = 0
-        if PAGE_ITEMS not in user_data:
-            user_data[PAGE_ITEMS] = {}
+    def search_text_filter(self, update: Update, context: CallbackContext) -> str:
+        """
+        Full-text search of typed words in items of other owners, best matches first.
+        Ids of ranked results are kept in user_data, paging does not run the query again.
+        """
+        self.remove_page_messages(update,  context)
+        pages.messages_of(context.chat_data, PAGE_MASSAGES).append(update.message.message_id)
+        user_data = context.user_data
 
+        cursor = user_data.get(PREV_PAGE)
+        if (not isinstance(cursor, dict)):
+            cursor = {'page': 0, 'first': None, 'last': None, 'count': None, 'counted': 0.0}
+            user_data[PREV_PAGE] = cursor
+        #typed query restarts the search, value of the chat's item may have changed or it was traded meanwhile
+        cursor.pop('max_value', None)
+        query = update.message.text.strip()
+        condition = self.affordable_condition(update.effective_chat.id, cursor)
+        user_data[TEXT_QUERY] = {'query': query, 'ids': self.items.search_text(condition, query, C.TEXT_SEARCH_LIMIT), 'page': 0}
+        return self.text_search_page(update, context, None)
+
+    def text_search_page(self, update: Update, context: CallbackContext, direction, new_header: bool = False) -> str:
+        results = context.user_data[TEXT_QUERY]
+        pagesTotal = (len(results['ids']) + PAGE_SIZE - 1) // PAGE_SIZE
+        page = results['page']
+        if (direction == NEXT_PAGE):
+            page = min(page + 1, max(pagesTotal - 1, 0))
+        elif (direction == PREV_PAGE):
+            page = max(page - 1, 0)
+        results['page'] = page
+
+        ids = results['ids'][page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+        #items traded since the query are left out of the page
+        condition = self.affordable_condition(update.effective_chat.id, context.user_data[PREV_PAGE])
+        items = self.items.by_ids(ids, condition) if ids else []
+        return self.show_search_page(update, context, items, page, len(results['ids']), page > 0, page + 1 < pagesTotal,
+            f"item(s) found for \"{results['query']}\".", new_header)
+
+    def show_search_page(self, update: Update, context: CallbackContext, items: list, page: int, count: int,
+                         has_prev: bool, has_next: bool, summary: str, new_header: bool = False) -> str:
+        """
+        Header with paging buttons and one message with trade button per item, as answer to button or typed query.
+        Header of a button is edited, unless new_header asks for a new one.
+        """
+        page_messages = pages.messages_of(context.chat_data, PAGE_MASSAGES)
+        page_items = pages.items_of(context.user_data, PAGE_ITEMS)
+        chat_id = update.effective_chat.id
 
-        offset = int(user_data[PREV_PAGE])
-        if (update.callback_query.data == PREV_PAGE):
-            offset = offset - PAGE_SIZE
-        elif (update.callback_query.data == NEXT_PAGE):
-            offset = offset + PAGE_SIZE
-        user_data[PREV_PAGE] = offset
-        #print(f"count:{count}, offset:{offset}")
         buttons = []
-        if (offset > 0 and offset >= PAGE_SIZE):
+        if (has_prev):
             buttons.append(InlineKeyboardButton(text='⬅️Prev page', callback_data=str(PREV_PAGE)))
-        if (offset + PAGE_SIZE < count):
+        if (has_next):
             buttons.append(InlineKeyboardButton(text='➡️Next page', callback_data=str(NEXT_PAGE)))
         buttons.append(InlineKeyboardButton(text='🔙Back to main menu', callback_data=str(END)))
         keyboard = InlineKeyboardMarkup([buttons])
 
-        items = self.botDB["items"].find(condition).skip(offset).limit(PAGE_SIZE)
-
+        pagesTotal = int(count/PAGE_SIZE)
+        if (count % PAGE_SIZE)>0:
+            pagesTotal +=1
+        _text = (f"Page {page + 1} of {pagesTotal}. {count} {summary}")
         if bool(update.callback_query):
-            pagesTotal = int(count/PAGE_SIZE)
-            if (count % PAGE_SIZE)>0:
-                pagesTotal +=1
-            _text = (f"Page {int(offset/PAGE_SIZE) + 1} of {pagesTotal}. {count} item(s) found in total.") #You can type to search by text
+            update.callback_query.answer()
+        if (bool(update.callback_query) and not new_header):
             if (_text != update.callback_query.message.text):
-                update.callback_query.answer()
                 update.callback_query.edit_message_text(text=_text, reply_markup=keyboard)
-        itemNo = int(offset * PAGE_SIZE)
+        else:
+            reply_message = context.bot.send_message(chat_id=chat_id, text=_text, reply_markup=keyboard)
+            page_messages.append(reply_message.message_id)
+        #resolve all owners of the page at once, names saved with item do not need a lookup
+        owners = self.profiles.resolve(context.bot, [item['chat_id'] for item in items if not item.get('owner_name')])
+        itemNo = page * PAGE_SIZE
+        albums = []
         for item in items:
             _text = ""
             _image_ids = ""
@@ -311,38 +411,28 @@ class Bot:
                 if (key =='Images'):
                     _image_ids = str(value)
                 if (key =='chat_id'):
-                    facts['Owner'] = self.get_user_info(value, context)
+                    facts['Owner'] = item.get('owner_name') or owners[value]
 
             _text = Bot.facts_to_str(facts)
-            item_message = context.bot.send_message(chat_id=update.callback_query.message.chat_id
+            item_message = context.bot.send_message(chat_id=chat_id
                 ,text=_text
                 , reply_markup=InlineKeyboardMarkup([[
                         InlineKeyboardButton(text='🛒Trade Item No: '+str(itemNo), callback_data=str(SAVING))
                     ]])
                 #, reply_to_message_id=update.callback_query.message.message_id
                 , parse_mode='MarkdownV2') #ParseMode.MARKDOWN_V2
-            chat_data[PAGE_MASSAGES].append(item_message.message_id)
-            user_data[PAGE_ITEMS][item_message.message_id] = item['_id']
-
-            #context.bot.send_media_group(chat_id=get_chat_id(update, context), media=list)
-            if (_image_ids != ""):
-                for image_id in _image_ids.split('|'):
-                    if (image_id != ""):
-                        try:
-                            image_message = context.bot.send_photo(chat_id=update.callback_query.message.chat_id
-                                , reply_to_message_id=item_message.message_id
-                                , photo=image_id
-                                , caption="Attached image")
-                            chat_data[PAGE_MASSAGES].append(image_message.message_id)
-                        except:
-                            pass
+            page_messages.append(item_message.message_id)
+            page_items[item_message.message_id] = item['_id']
+            albums.append((_image_ids, item_message.message_id))
 
+        #photos of all items of the page are sent concurrently as albums
+        page_messages.extend(self.media.render(context.bot, chat_id, albums))
         return SEARCHING
 
     def item_details(self, update: Update, context: CallbackContext) -> str:
         """Pretty print gathered data."""
         #print("item_details")
-        item = self.botDB["items"].find_one({"chat_id": update.callback_query.message.chat_id})
+        item = self.items.by_owner(update.callback_query.message.chat_id)
         chat_data = context.chat_data
 
         if (item is not None and update.callback_query.data == DOWNLOADING):
@@ -353,9 +443,9 @@ class Bot:
                         message = context.bot.sendDocument(chat_id=update.callback_query.message.chat_id,
                         document=file_id,
                         caption = 'Attached file')
-                        chat_data[PAGE_MASSAGES].append(message.message_id)
-                    except:
-                        pass
+                        pages.messages_of(chat_data, PAGE_MASSAGES).append(message.message_id)
+                    except TelegramError as e:  # RetryAfter is retried by the bot, what is left is logged
+                        logger.warning(f"Could not send file of item {item['_id']}: {e}")
             return SHOWING
 
         buttons = [InlineKeyboardButton(text='🔙Back', callback_data=str(END))]
@@ -370,17 +460,10 @@ class Bot:
                 if (key == 'Files'):
                     buttons.insert(0, InlineKeyboardButton(text='💾Download', callback_data=str(DOWNLOADING)))
                 elif (key =='Images'):
-                    _ids = str(value).strip('|').split('|')
-                    for image_id in _ids:
-                        if (image_id != ""):
-                            try:
-                                message = context.bot.send_photo(chat_id=update.callback_query.message.chat_id
-                                    , reply_to_message_id=update.callback_query.message.message_id
-                                    , photo=image_id
-                                    , caption="Attached image")
-                                chat_data[PAGE_MASSAGES].append(message.message_id)
-                            except:
-                                pass
+                    pages.messages_of(chat_data, PAGE_MASSAGES).extend(self.media.send_images(context.bot
+                        , update.callback_query.message.chat_id
+                        , value
+                        , reply_to_message_id=update.callback_query.message.message_id))
             _text += Bot.facts_to_str(facts)
             url = helpers.create_deep_linked_url(bot_username=context.bot.name.strip('@'), payload=f"{item['_id']}") #, group=False
             #https://t.me/{context.bot.name.strip('@')}?trade={item['_id']}
@@ -429,7 +512,7 @@ class Bot:
                 update.callback_query.edit_message_text(text=_text, reply_markup=edit_item_keyboard)
         elif bool(update.message):
             if VOICE in user_data:
-                _text = "Oh, did you say this? "+ user_data[VOICE]
+                _text = "Oh, did you say this? "+ helpers.escape_markdown(user_data[VOICE], version=2)
                 update.message.reply_text(text=_text, reply_markup=edit_item_keyboard, parse_mode='MarkdownV2')
                 del user_data[VOICE]
             else:
@@ -438,13 +521,13 @@ class Bot:
                     reply_to_file = context.bot.send_message(chat_id=update.message.chat_id
                         , reply_to_message_id=update.message.message_id
                         , text=_text, parse_mode='MarkdownV2')
-                    chat_data[PAGE_MASSAGES].append(reply_to_file.message_id)
+                    pages.messages_of(chat_data, PAGE_MASSAGES).append(reply_to_file.message_id)
                 elif ('Images' in user_data and bool(update.message.photo)):
                     _text = "The photo will be visible *for all*\!"
                     reply_to_file = context.bot.send_message(chat_id=update.message.chat_id
                         , reply_to_message_id=update.message.message_id
                         , text=_text, parse_mode='MarkdownV2')
-                    chat_data[PAGE_MASSAGES].append(reply_to_file.message_id)
+                    pages.messages_of(chat_data, PAGE_MASSAGES).append(reply_to_file.message_id)
                 else:
                     _text = ("Got it\! Keep changing and click *💾Save* to finish update, or *Back* to cancel and return"
                         f"{Bot.facts_to_str(user_data)}")
@@ -510,21 +593,17 @@ class Bot:
         
         facts = Bot.facts_to_save(user_data)
         facts['chat_id'] = update.callback_query.message.chat_id
-        items_coll = self.botDB["items"]
-        item = items_coll.find_one({"chat_id": facts['chat_id']})
-        if (item is None):
-            inserted_item = items_coll.insert_one(facts)
-            if (bool(inserted_item)):
-                _id = str(inserted_item.inserted_id)
-                update.callback_query.answer()
-                update.callback_query.edit_message_text(text=f"The item {_id} is inserted")
-        elif (bool(item)):
-            _id = item['_id']
-            edited_item = items_coll.find_one_and_update(filter={"_id": ObjectId(_id), "chat_id": facts['chat_id']}, 
-                update={"$set": facts}, upsert=True, return_document=True)
-            if (bool(edited_item)):
-                update.callback_query.answer()
-                update.callback_query.edit_message_text(text=f"👏Welldone! The item is updated and ready to trade")
+        facts['owner_name'] = chat_display_name(update.callback_query.message.chat, facts['chat_id'])
+        self.profiles.remember(facts['chat_id'], facts['owner_name'])
+        #numeric copy of Value lets search filter items by it
+        if ('Value' in facts):
+            facts['value_cents'] = DB.value_cents(facts['Value'])
+        _id, inserted = self.items.save(facts)
+        update.callback_query.answer()
+        if (inserted):
+            update.callback_query.edit_message_text(text=f"The item {_id} is inserted")
+        else:
+            update.callback_query.edit_message_text(text=f"👏Welldone! The item is updated and ready to trade")
 
         user_data.clear()
         self.remove_page_messages(update,  context)
@@ -545,45 +624,33 @@ class Bot:
         if update.message.photo[0].file_id not in user_data['Images']: 
             user_data['Images'] += (update.message.photo[0].file_id).strip('|')
 
-        chat_data[PAGE_MASSAGES].append(update.message.message_id)
+        pages.messages_of(chat_data, PAGE_MASSAGES).append(update.message.message_id)
 
         return self.item_edit(update, context)
 
     def received_voice(self, update: Update, context: CallbackContext):
         """
-        bot sends audio to IBM Speech to Text: 
-        https://cloud.ibm.com/catalog/services/speech-to-text
-        https://cloud.ibm.com/apidocs/speech-to-text?code=python#recognize
+        voice is recognized in background by speech queue, the edit menu is sent when transcript is ready.
+        If user was typing a category value, the transcript becomes that value.
         """
-        # print(update.message.voice)
-        #voice_content = update.message.voice.get_file()
-        # context.bot.get_file(update.message.voice.file_id)
-        voice_content = update.message.voice.get_file()
         chat_data = context.chat_data
-        chat_data[PAGE_MASSAGES].append(update.message.message_id)
-
+        pages.messages_of(chat_data, PAGE_MASSAGES).append(update.message.message_id)
         user_data = context.user_data
-        #try:
-        speech_recognition_results = self.speech_to_text.recognize(
-            audio=voice_content.download_as_bytearray(),
-            #https://cloud.ibm.com/apidocs/speech-to-text-icp?code=python
-            content_type='audio/l16', #Audio formats (content types)
-            
-            word_alternatives_threshold=0.9,
-            keywords=['name', 'value', 'description', 'category', 'save', 'back'],
-            keywords_threshold=0.5
-        ).get_result()
-
-        if speech_recognition_results.status_code != 200 or not speech_recognition_results:
-            user_data[VOICE] = "Sorry, I could not hear you well :("
-        else:
-            user_data[VOICE] = str(json.dumps(speech_recognition_results, indent=2))
-            print("VOICE"+ user_data[VOICE])
-        #except:
-        #    print("Unexpected voice error:", sys.exc_info()[0])
-        #    pass
 
-        return self.item_edit(update, context)
+        def transcribed(transcript):
+            if not transcript:
+                user_data[VOICE] = "Sorry, I could not hear you well :("
+            else:
+                user_data[VOICE] = transcript
+                if CATEGORY in user_data:
+                    user_data[user_data[CATEGORY]] = transcript
+                    del user_data[CATEGORY]
+            self.item_edit(update, context)
+
+        if not self.speech.submit(update.message.voice, transcribed):
+            user_data[VOICE] = "Sorry, I am too busy to listen now, please type it"
+            return self.item_edit(update, context)
+        return SELECTING_FEATURE
 
     def trade_command(self, update: Update, context: CallbackContext):
         print('trade_command')
@@ -610,7 +677,7 @@ class Bot:
         item = None
         if (item_id != None):
             try:
-                item = self.botDB["items"].find_one(filter={"_id": ObjectId(item_id)})
+                item = self.items.by_id(item_id, repositories.SEARCH_CARD)
             except:
                 item = None
 
@@ -621,11 +688,10 @@ class Bot:
         if (validation_error !=""):
             #print ("trade_command validation error:"+validation_error)
             reply_message = context.bot.send_message(chat_id=chat_id ,text=validation_error)
-            chat_data[PAGE_MASSAGES].append(reply_message.message_id)
+            pages.messages_of(chat_data, PAGE_MASSAGES).append(reply_message.message_id)
             return SEARCHING
 
-        if PAGE_ITEMS not in user_data:
-            user_data[PAGE_ITEMS] = {}
+        page_items = pages.items_of(user_data, PAGE_ITEMS)
 
         self.remove_page_messages(update,  context)
         facts={}
@@ -659,19 +725,13 @@ class Bot:
             else:
                 print("trade_command response3")
                 reply_message = context.bot.send_message(chat_id=chat_id, text=_text, reply_markup=keyboard, parse_mode='MarkdownV2')
-                chat_data[PAGE_MASSAGES].append(reply_message.message_id)
+                pages.messages_of(chat_data, PAGE_MASSAGES).append(reply_message.message_id)
                 message_id = reply_message.message_id
 
             if (message_id > 0 and _image_ids !=""):
-                for image_id in _image_ids.split('|'):
-                    if (image_id != ""):
-                        image_message = context.bot.send_photo(chat_id=chat_id
-                            , reply_to_message_id=message_id
-                            , photo=_image_ids[0]
-                            , caption="Attached image")
-                        chat_data[PAGE_MASSAGES].append(image_message.message_id)
-
-            user_data[PAGE_ITEMS][message_id] = item_id
+                pages.messages_of(chat_data, PAGE_MASSAGES).extend(self.media.send_images(context.bot, chat_id, _image_ids, reply_to_message_id=message_id))
+
+            page_items[message_id] = item_id
             print("trade_command redirect:"+ item_id)
             return SEARCHING #self.trade_commit(update, context)
 
@@ -686,8 +746,7 @@ class Bot:
         item2 = None
         message_id = None
         validation_error=""
-        if PAGE_ITEMS not in user_data:
-            user_data[PAGE_ITEMS] = {}
+        page_items = pages.items_of(user_data, PAGE_ITEMS)
 
         try:            
             if bool(update.callback_query):
@@ -701,89 +760,74 @@ class Bot:
 
         print('trade_commmit chat_id:'+str(chat_id1))
 
-        items_coll = self.botDB["items"]
         if (chat_id1 != None):
             try:
-                item1 = items_coll.find_one({"chat_id": chat_id1})
+                item1 = self.items.by_owner(chat_id1, repositories.TRADE_CHECK)
             except:
                 pass
 
+        item2_id = None
         if (message_id != None):
             try:
-                if message_id in user_data[PAGE_ITEMS]:
-                    item2 = items_coll.find_one(filter={"_id": ObjectId(user_data[PAGE_ITEMS][message_id])})
-                    del user_data[PAGE_ITEMS][message_id]
+                if message_id in page_items:
+                    item2_id = ObjectId(page_items[message_id])
+                    item2 = self.items.by_id(item2_id, repositories.TRADE_CHECK)
+                    del page_items[message_id]
             except:
                 item2=None
 
-        if (item1 is None):
-            validation_error = "❌Sorry, you have no item to trade-in with others yet, please update your item first!"
-        elif (item2 is None):
-            validation_error = "❌Sorry, that item is not avaialable anymore!"
-        elif (item1['_id'] == item2['_id']):
-            validation_error = "❌Sorry, the item for trade is the same"
-        elif (item1['chat_id'] == item2['chat_id']):
-            validation_error = "❌Sorry, both items have the same owner"
-        elif (Bot.get_value_from_string(item1['Value']) < Bot.get_value_from_string(item2['Value'])):
-            validation_error = "❌Sorry, your item has lower value."
-        else:
-            #check if owner2 traded item1 before
-            trade_count = self.botDB["transactions"].count_documents(filter={"item_id": item1['_id'], "from_chat_id": item2['chat_id']})
-            if (trade_count>0):
-                validation_error = f"❌Sorry, Your item {item1['Name']} was already preowned by that person and can't be trade-in again"
-            else:
-                #check if owner1 traded item2 before
-                trade_count = self.botDB["transactions"].count_documents(filter={"item_id": item2['_id'], "from_chat_id": item1['chat_id']})
-                if (trade_count>0):
-                    validation_error = f"❌Sorry, that {item2['Name']} was already preowned by you and can't be trade-in again"
+        #early check before owner names are resolved, it's repeated inside the transaction
+        validation_error = Bot.trade_validation_error(item1, item2)
+        if (validation_error == ""):
+            owners = self.profiles.resolve(context.bot, [item1['chat_id'], item2['chat_id']])
+            try:
+                item1, item2 = DB.execute_trade(self.myclient, self.botDB, chat_id1, item2_id,
+                                                Bot.trade_validation_error, owners)
+            except DB.TradeRejected as e:
+                validation_error = str(e)
+            except PyMongoError as e:
+                logger.warning(f"Trade of {chat_id1} for {item2_id} failed: {e}")
+                validation_error = "❌Sorry, the trade-in failed, please try again later"
 
         if (validation_error !=""):
-            reply_message = context.bot.send_message(chat_id=item1['chat_id'] ,text=validation_error)
-            chat_data[PAGE_MASSAGES].append(reply_message.message_id)
+            reply_message = context.bot.send_message(chat_id=chat_id1 ,text=validation_error)
+            pages.messages_of(chat_data, PAGE_MASSAGES).append(reply_message.message_id)
 
             return SEARCHING
 
-        trans_coll = self.botDB["transactions"]
-        trans1 = dict() #Dict[str, Any]
-        trans1['trans_date'] = datetime.now()
-        trans1['item_id'] = item1['_id']
-        trans1['from_chat_id'] = item1['chat_id']
-        trans1['to_chat_id'] = item2['chat_id']
-        trans2 = dict()
-        trans2['trans_date'] = trans1['trans_date']
-        trans2['item_id'] = item2['_id']
-        trans2['from_chat_id'] = item2['chat_id']
-        trans2['to_chat_id'] = item1['chat_id']
-
-        #print("start multi-document transaction") 
-        #https://pymongo.readthedocs.io/en/stable/api/pymongo/client_session.html
-        with self.myclient.start_session() as session:
-            with session.start_transaction():
-                reply1 = trans_coll.insert_many([trans1, trans2], session=session)
-                if (reply1.acknowledged==True and len(reply1.inserted_ids)==2):
-                    items_coll.find_one_and_update(filter={'_id': ObjectId(item1['_id']), 'chat_id': item1['chat_id']}, 
-                            update={'$set': {'chat_id': item2['chat_id'] } },
-                            projection = { "_id" : True }, 
-                            session=session) #, upsert=True, return_document = True
-                    items_coll.find_one_and_update(filter={'_id': ObjectId(item2['_id']), 'chat_id': item2['chat_id']}, 
-                            update={'$set': {'chat_id': item1['chat_id'] } },
-                            projection = { "_id" : True }, 
-                            session=session) #, upsert=True, return_document = True
-                    session.commit_transaction()
-                    #print("transaction commited")
-                    try: #try to notify owners, do not use answer/reply, parent message does not already exist
-                        _text = "👏The trade-in is done! Check your new item details by running /start command"
-                        reply_message = context.bot.send_message(chat_id=item1['chat_id'], text=_text)
-                        chat_data[PAGE_MASSAGES].append(reply_message.message_id)
-                        
-                        context.bot.send_message(chat_id=item2['chat_id'] ,text=_text)
-                    except:
-                        pass
-        #print("end transaction")
+        try: #try to notify owners, do not use answer/reply, parent message does not already exist
+            _text = "👏The trade-in is done! Check your new item details by running /start command"
+            reply_message = context.bot.send_message(chat_id=item1['chat_id'], text=_text)
+            pages.messages_of(chat_data, PAGE_MASSAGES).append(reply_message.message_id)
+
+            context.bot.send_message(chat_id=item2['chat_id'] ,text=_text)
+        except TelegramError as e:
+            logger.warning(f"Could not notify owners of trade-in: {e}")
         user_data.clear()
         #return self.start(update, context)
         return END
 
+    @staticmethod
+    def trade_validation_error(item1, item2) -> str:
+        """Reason why item1 can't be traded for item2, empty if it can"""
+        if (item1 is None):
+            return "❌Sorry, you have no item to trade-in with others yet, please update your item first!"
+        elif (item2 is None):
+            return "❌Sorry, that item is not avaialable anymore!"
+        elif (item1['_id'] == item2['_id']):
+            return "❌Sorry, the item for trade is the same"
+        elif (item1['chat_id'] == item2['chat_id']):
+            return "❌Sorry, both items have the same owner"
+        elif (DB.item_value_cents(item1) < DB.item_value_cents(item2)):
+            return "❌Sorry, your item has lower value."
+        #check if owner2 traded item1 before
+        elif (item2['chat_id'] in item1.get('preowned_by', [])):
+            return f"❌Sorry, Your item {item1['Name']} was already preowned by that person and can't be trade-in again"
+        #check if owner1 traded item2 before
+        elif (item1['chat_id'] in item2.get('preowned_by', [])):
+            return f"❌Sorry, that {item2['Name']} was already preowned by you and can't be trade-in again"
+        return ""
+
 
     def received_document(self, update: Update, context: CallbackContext):
         """
@@ -804,7 +848,7 @@ class Bot:
         if update.message.document.file_id not in user_data[fileType]: 
             user_data[fileType] += (update.message.document.file_id).strip('|')
 
-        chat_data[PAGE_MASSAGES].append(update.message.message_id)
+        pages.messages_of(chat_data, PAGE_MASSAGES).append(update.message.message_id)
 
         return self.item_edit(update, context)
 
@@ -824,6 +868,18 @@ class Bot:
                 ,text='🏁Thank you. See you next time!')
         return END
 
+    def please_wait(self, update: Update, context: CallbackContext) -> None:
+        """
+        Answer a button pressed or a message sent while the previous request is handled,
+        conversation keeps its pending state
+        """
+        metrics.increment('conversation.waiting')
+        text = '⏳Please wait, the previous request is still running'
+        if (update.callback_query):
+            update.callback_query.answer(text=text)
+        else:
+            update.effective_message.reply_text(text + ', then send your message again')
+
     #stop and stop_nested are similar but operates on different levels
     def stop(self, update: Update, context: CallbackContext) -> int:
         """End Conversation by command."""
@@ -869,19 +925,37 @@ class Bot:
             "\n-👍Good luck in your trade-in process!"
         )
         chat_data = context.chat_data
-        if PAGE_MASSAGES not in chat_data:
-            chat_data[PAGE_MASSAGES] = []
-        chat_data[PAGE_MASSAGES].append(reply.message_id)
-        
-    def run(self) -> None:
-        """Run the bot."""
-        # Create the Updater and pass it your bot's token.
-        updater = Updater(C.TELEGRAM_TOKEN)
-        # Get the dispatcher to register handlers
-        dispatcher = updater.dispatcher
+        pages.messages_of(chat_data, PAGE_MASSAGES).append(reply.message_id)
+
+    def memory_command(self, update: Update, context: CallbackContext):
+        """Debug report of page bookkeeping held in memory, for chats of C.DEBUG_CHAT_IDS only"""
+        if (update.effective_chat.id not in C.DEBUG_CHAT_IDS):
+            return
+        page_messages = pages.messages_of(context.chat_data, PAGE_MASSAGES)
+        page_items = pages.items_of(context.user_data, PAGE_ITEMS)
+        chats, message_ids, messages_bytes = pages.usage(context.dispatcher.chat_data, PAGE_MASSAGES)
+        users, items, items_bytes = pages.usage(context.dispatcher.user_data, PAGE_ITEMS)
+        update.message.reply_text(
+            f"This chat: {len(page_messages)} page messages ({page_messages.nbytes()} bytes), "
+            f"{len(page_items)} page items ({page_items.nbytes()} bytes)"
+            f"\nChats in memory: {len(context.dispatcher.chat_data)}, users in memory: {len(context.dispatcher.user_data)}"
+            f"\nPage messages: {message_ids} in {chats} chats, {messages_bytes} bytes"
+            f"\nPage items: {items} of {users} users, {items_bytes} bytes"
+        )
 
+    def add_handlers(self, dispatcher, run_async: bool = True) -> None:
+        """
+        Register handlers of the bot. Pages of search, text search, history, item details and trade commit wait mostly
+        for database and Bot API, with run_async they run in dispatcher worker threads and updates of other
+        chats are not queued behind them. Conversations do not queue updates of the same chat while such a handler
+        is pending, buttons pressed and messages sent meanwhile are answered by please_wait and the user repeats them.
+        """
+        #conversations survive restarts when dispatcher has persistence
+        persistent = dispatcher.persistence is not None
         # Set up top level ConversationHandler (selecting action)
         conv_handler = ConversationHandler(
+            name="main",
+            persistent=persistent,
             entry_points=[
                 #deep link start from promoted deep link like: https://t.me/CreativeTradeInBot/trade=60e91064f508f554a10a3847
                 CommandHandler('start', self.trade_command, Filters.regex('[a-z0-9]{24}'), pass_args=True), 
@@ -891,25 +965,26 @@ class Bot:
             states={
                 SELECTING_ACTION: [
                     CallbackQueryHandler(self.item_edit, pattern='^' + str(EDITING) + '$'),
-                    CallbackQueryHandler(self.item_details, pattern='^' + str(SHOWING) + '$'),
-                    CallbackQueryHandler(self.search, pattern='^' + str(SEARCHING) +"|"+ str(PREV_PAGE) +"|"+ str(NEXT_PAGE) + '$'),
-                    CallbackQueryHandler(self.history, pattern='^' + str(TRACKING) + '$'),
+                    CallbackQueryHandler(self.item_details, pattern='^' + str(SHOWING) + '$', run_async=run_async),
+                    CallbackQueryHandler(self.search, pattern='^' + str(SEARCHING) +"|"+ str(PREV_PAGE) +"|"+ str(NEXT_PAGE) + '$', run_async=run_async),
+                    CallbackQueryHandler(self.history, pattern='^' + str(TRACKING) + '$', run_async=run_async),
                     
                     CallbackQueryHandler(self.end, pattern='^' + str(END) + '$'), #Back button
                 ],
                 #these states are used by Back buttons
                 EDITING: [CallbackQueryHandler(self.start, pattern='^' + str(SELECTING_FEATURE) + '$')],
                 SHOWING: [
-                    CallbackQueryHandler(self.item_details, pattern='^' + str(DOWNLOADING) + '$'),
+                    CallbackQueryHandler(self.item_details, pattern='^' + str(DOWNLOADING) + '$', run_async=run_async),
                     CallbackQueryHandler(self.start, pattern='^' + str(END) + '$'), #Back button
                 ],
                 SEARCHING:[
-                    CallbackQueryHandler(self.search, pattern='^' + str(SEARCHING) +"|"+ str(PREV_PAGE) +"|"+ str(NEXT_PAGE) + '$'),
+                    CallbackQueryHandler(self.search, pattern='^' + str(SEARCHING) +"|"+ str(PREV_PAGE) +"|"+ str(NEXT_PAGE) + '$', run_async=run_async),
                     CallbackQueryHandler(self.start, pattern='^' + str(END) + '$'), #Back button
-                    CallbackQueryHandler(self.trade_commit, pattern='^' + str(SAVING) + '$'),
-                    MessageHandler(Filters.text & ~Filters.command, self.search_text_filter),
+                    CallbackQueryHandler(self.trade_commit, pattern='^' + str(SAVING) + '$', run_async=run_async),
+                    MessageHandler(Filters.text & ~Filters.command, self.search_text_filter, run_async=run_async),
                 ],
                 TRACKING:[
+                    CallbackQueryHandler(self.history, pattern='^' + str(PREV_PAGE) +"|"+ str(NEXT_PAGE) + '$', run_async=run_async),
                     CallbackQueryHandler(self.start, pattern='^' + str(END) + '$'), #Back button
                     #CallbackQueryHandler(self.ext_item_details, pattern='^' + str(SHOWING) + '$'),
                 ],
@@ -933,10 +1008,16 @@ class Bot:
                 ],
                 TYPING: [
                     MessageHandler(Filters.text & ~Filters.command, self.received_information),
+                    MessageHandler(Filters.voice, self.received_voice),
                 ],
                 #SAVING:[CallbackQueryHandler(self.edit_commit, pattern='^' + str(END) + '$'),],
 
                 STOPPING: [CommandHandler('start', self.start)],
+                #buttons pressed and messages sent while an async handler of the chat is running
+                ConversationHandler.WAITING: [
+                    CallbackQueryHandler(self.please_wait),
+                    MessageHandler(~Filters.command, self.please_wait),
+                ],
             },
             fallbacks=[
                 CommandHandler('stop', self.stop),
@@ -949,14 +1030,20 @@ class Bot:
 
         #direct trading
         direct_trade_handler = ConversationHandler(
+            name="direct_trade",
+            persistent=persistent,
             entry_points=[CommandHandler('trade', self.trade_command, Filters.regex('[a-z0-9]{24}'), pass_args=True)], 
             states={
                 SEARCHING:[
-                    CallbackQueryHandler(self.trade_commit, pattern='^' + str(SAVING) + '$'),
+                    CallbackQueryHandler(self.trade_commit, pattern='^' + str(SAVING) + '$', run_async=run_async),
                     CallbackQueryHandler(self.start, pattern='^' + str(END) + '$'), #Back button
                 ],
 
                 STOPPING: [CommandHandler('start', self.start)],
+                ConversationHandler.WAITING: [
+                    CallbackQueryHandler(self.please_wait),
+                    MessageHandler(~Filters.command, self.please_wait),
+                ],
             },
             fallbacks=[
                 CommandHandler('stop', self.stop),
@@ -967,29 +1054,28 @@ class Bot:
         #help handler
         dispatcher.add_handler(CommandHandler('stop', self.stop))
         dispatcher.add_handler(CommandHandler("help", self.help_command))
+        dispatcher.add_handler(CommandHandler("memory", self.memory_command))
         #general conversation
         dispatcher.add_handler(MessageHandler(Filters.text, self.handle_message))
         dispatcher.add_error_handler(self.error)
 
+    def create_updater(self) -> Updater:
+        """Updater with persistence, handlers and jobs of the bot, not started yet"""
+        persistence = BatchedPersistence(MongoStore(self.botDB["bot3_persistence"]))
+        updater = runtime.new_updater(persistence)
+        self.add_handlers(updater.dispatcher)
+        updater.job_queue.run_repeating(metrics.log_snapshot, interval=C.METRICS_LOG_INTERVAL, first=C.METRICS_LOG_INTERVAL)
+        updater.job_queue.run_repeating(persistence.flush_job, interval=C.PERSISTENCE_FLUSH_INTERVAL)
+        return updater
+
+    def run(self) -> None:
+        """Run the bot."""
+        runtime.run(self.create_updater, create_updater)
 
-        # Run bot
-        if C.HEROKU_APP_NAME == "":  #pooling mode
-            logger.info(
-                "Can't detect 'HEROKU_APP_NAME' env. Running bot in pooling mode.")
-            updater.start_polling(1)
-        else:  #webhook mode
-            PORT = int(os.environ.get('PORT', C.HEROKU_PORT))
-            updater.start_webhook(
-                listen="0.0.0.0",
-                port=PORT,
-                url_path=C.TELEGRAM_TOKEN,
-                webhook_url=f"https://{C.HEROKU_APP_NAME}.herokuapp.com/{C.TELEGRAM_TOKEN}"
-            )
 
-        # Run the bot until you press Ctrl-C or the process receives SIGINT,
-        # SIGTERM or SIGABRT. This should be used most of the time, since
-        # start_polling() is non-blocking and will stop the bot gracefully.
-        updater.idle()
+def create_updater() -> Updater:
+    """Bot of a webhook worker process"""
+    return Bot().create_updater()
 
 
 if __name__ == '__main__':
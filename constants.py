@@ -7,3 +7,89 @@ IBM_SERVICE_URL = '***'
 IBM_API_URL = '***'
 IBM_KEY = '***'
 
+
+# owners' display names resolved with get_chat are cached for this many seconds
+PROFILE_CACHE_TTL = 600
+PROFILE_FETCH_WORKERS = 8
+# search total count is recalculated not more often than every this many seconds
+SEARCH_COUNT_TTL = 60
+# threads sending items' photos of one page concurrently
+MEDIA_WORKERS = 4
+# threads deleting messages of previous pages in background
+CLEANUP_WORKERS = 4
+# speech recognition backends in order of preference: ibm, vosk
+SPEECH_BACKENDS = "ibm,vosk"
+SPEECH_WORKERS = 2
+SPEECH_QUEUE_SIZE = 20
+VOSK_MODEL_PATH = "model"
+# words of bot3 menu the ibm backend is asked to spot in voice notes
+SPEECH_KEYWORDS = ['name', 'value', 'description', 'category', 'save', 'back']
+# bot1 thumbnails process pool
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_QUEUE_DEPTH = 32
+# bot1 uploads
+MAX_PHOTO_BYTES = 5000000
+MAX_FILE_BYTES = 10000000
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_TIMEOUT = 60
+# bot1 uploads without references are removed after grace period, checked every interval (seconds)
+BLOB_GC_INTERVAL = 3600
+BLOB_GC_GRACE = 86400
+# bot1 trade conversations idle for longer are dropped (seconds)
+TRADE_SESSION_TTL = 1800
+# dispatcher threads running handlers concurrently (run_async), and threads for queries a bot3 handler overlaps
+DISPATCHER_WORKERS = 8
+QUERY_WORKERS = 4
+# MongoDB client shared by the process: pool limits, timeouts (ms) and default read/write concerns
+MONGO_MAX_POOL_SIZE = 50
+MONGO_MIN_POOL_SIZE = 2
+MONGO_MAX_IDLE_TIME_MS = 300000
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 5000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SOCKET_TIMEOUT_MS = 30000
+MONGO_WRITE_CONCERN = "majority"
+MONGO_READ_CONCERN = "local"
+# bot2 and bot3 write metrics to the log every interval (seconds)
+METRICS_LOG_INTERVAL = 300
+# results of typed search query kept for paging
+TEXT_SEARCH_LIMIT = 100
+# characters of item description in bot2 search results, the whole reply is one message
+SEARCH_DESCRIPTION_LENGTH = 300
+# conversations, user_data and chat_data changed since the last flush are saved every interval (seconds)
+PERSISTENCE_FLUSH_INTERVAL = 10
+# bot3 page bookkeeping: message ids kept per chat for removal, trade buttons kept per user, entries dropped after max age (seconds)
+PAGE_MESSAGES_CAPACITY = 256
+PAGE_ITEMS_CAPACITY = 128
+PAGE_STATE_MAX_AGE = 86400
+# chats allowed to use bot3 debug commands
+DEBUG_CHAT_IDS = []
+# Bot API endpoints, point them to a local fake server for testing
+TELEGRAM_BASE_URL = "https://api.telegram.org/bot"
+TELEGRAM_BASE_FILE_URL = "https://api.telegram.org/file/bot"
+# webhook front end: worker processes, updates queued per worker, seconds Telegram waits before redelivery of rejected update
+WEBHOOK_WORKERS = 4
+WEBHOOK_QUEUE_SIZE = 100
+WEBHOOK_RETRY_AFTER = 1
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_STOP_TIMEOUT = 30
+WEBHOOK_SECRET_TOKEN = ""
+# polling: long-poll timeout and pause between getUpdates (seconds), updates per getUpdates (1-100),
+# updates sent while the bot was down are skipped on start (polling and webhook)
+POLL_TIMEOUT = 30
+POLL_INTERVAL = 0.0
+POLL_LIMIT = 100
+DROP_PENDING_UPDATES = False
+# updates per second and their lag are written to the log every interval (seconds)
+UPDATES_LOG_INTERVAL = 60
+# outbound Bot API budgets per process (requests per second and burst): all chats, private chat, group or channel;
+# a private chat takes a burst up to the global limit, a search page (header, items and albums) goes without waiting;
+# request is sent again after RetryAfter up to max retries, budgets of this many recent chats are kept
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_GLOBAL_BURST = 30
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 30
+OUTBOUND_GROUP_RATE = 20 / 60
+OUTBOUND_GROUP_BURST = 20
+OUTBOUND_MAX_RETRIES = 3
+OUTBOUND_MAX_CHATS = 10000
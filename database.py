@@ -0,0 +1,397 @@
+"""
+Client, queries, indexes and maintenance tasks for botDB collections used by bot2 and bot3.
+
+Usage:
+python database.py ensure-indexes
+python database.py check-indexes    exits with error if any bot query is a collection scan
+python database.py backfill-preowned
+python database.py migrate-values     fills numeric value_cents of items saved with text Value only
+python database.py migrate-categories fills text of custom categories of items saved before it was indexed
+"""
+import sys
+import time
+import logging
+import threading
+import argparse
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Callable, Dict, Optional
+import pymongo
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, UpdateOne, ReadPreference, monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+from bson.objectid import ObjectId
+import constants as C
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+
+# value_cents is stored as BSON int64
+MAX_VALUE_CENTS = 2 ** 63 - 1
+MIN_VALUE_CENTS = -2 ** 63
+MAX_VALUE_DIGITS = len(str(MAX_VALUE_CENTS))
+
+# indexes required by bot queries, creating existing ones is a no-op
+INDEXES = {
+    "items": [
+        IndexModel([("chat_id", ASCENDING)], name="chat_id"),
+        IndexModel([("owner_id", ASCENDING), ("Name", ASCENDING)], name="owner_id_Name"),
+        IndexModel([("value_cents", ASCENDING)], name="value_cents"),
+        IndexModel([("preowned_by", ASCENDING)], name="preowned_by"),  # multikey, items once owned by a chat
+        #user facing fields, custom categories are copied to 'categories' on save,
+        #an item field named 'language' must not switch stemming
+        IndexModel([("Name", TEXT), ("Description", TEXT), ("categories", TEXT)], name="text_fields",
+                   weights={"Name": 10, "Description": 5, "categories": 2}, language_override="text_language"),
+    ],
+    "transactions": [
+        IndexModel([("from_chat_id", ASCENDING), ("trans_date", DESCENDING)], name="from_chat_id_trans_date"),
+    ],
+}
+
+# replaced indexes, a collection has one text index only
+DROPPED_INDEXES = {
+    "items": ["text"],  # all string fields, file ids included
+}
+# item fields which are not custom categories: indexed on their own, numbers, file ids and bookkeeping
+ITEM_FIELDS = {"_id", "chat_id", "owner_id", "owner_name", "Name", "Value", "value_cents", "Description",
+               "Images", "Files", "Image", "Image_thumbnail", "preowned_by", "version", "categories", "text_language"}
+
+
+def categories_text(item: dict) -> str:
+    """Custom categories of the item with their values, text search indexes them instead of all fields"""
+    return " ".join(f"{key} {value}" for key, value in item.items()
+                    if key not in ITEM_FIELDS and isinstance(key, str) and isinstance(value, str))
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Reports how long threads wait to check out a pooled connection, and connection churn"""
+
+    def __init__(self):
+        self._started = threading.local()  # events of one check out come in the thread requesting it
+
+    def _waited(self) -> float:
+        return time.monotonic() - getattr(self._started, 'time', time.monotonic())
+
+    def connection_check_out_started(self, event):
+        self._started.time = time.monotonic()
+
+    def connection_checked_out(self, event):
+        metrics.observe('mongo.checkout_wait', self._waited())
+
+    def connection_check_out_failed(self, event):
+        metrics.increment(f'mongo.checkout_failed.{event.reason}')
+        metrics.observe('mongo.checkout_wait', self._waited())
+
+    def connection_created(self, event):
+        metrics.increment('mongo.connections_created')
+
+    def connection_closed(self, event):
+        metrics.increment('mongo.connections_closed')
+
+    def pool_cleared(self, event):
+        metrics.increment('mongo.pool_cleared')
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def get_client() -> pymongo.MongoClient:
+    """One client per process, created on first use. Pool limits, timeouts and concerns come from constants."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = pymongo.MongoClient(C.MONGODB_CONNECTION_URL,
+                                          maxPoolSize=C.MONGO_MAX_POOL_SIZE,
+                                          minPoolSize=C.MONGO_MIN_POOL_SIZE,
+                                          maxIdleTimeMS=C.MONGO_MAX_IDLE_TIME_MS,
+                                          waitQueueTimeoutMS=C.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                                          serverSelectionTimeoutMS=C.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                                          connectTimeoutMS=C.MONGO_CONNECT_TIMEOUT_MS,
+                                          socketTimeoutMS=C.MONGO_SOCKET_TIMEOUT_MS,
+                                          w=C.MONGO_WRITE_CONCERN,
+                                          readConcernLevel=C.MONGO_READ_CONCERN,
+                                          event_listeners=[PoolMetrics()])
+    return _client
+
+
+def get_db():
+    return get_client()["botDB"]
+
+
+def value_cents(data) -> int:
+    """
+    Item value typed as free text, like '$1,250.5', in cents.
+    Not a number, infinity or value out of BSON int64 range is 0.
+    """
+    try:
+        value = Decimal(str(data).replace(',', '').replace('$', '').strip(' '))
+        if (not value.is_finite() or value.adjusted() > MAX_VALUE_DIGITS):  # before a huge int is built
+            return 0
+        cents = int((value * 100).to_integral_value(rounding=ROUND_HALF_UP))
+    except (ArithmeticError, ValueError):
+        return 0
+    return cents if MIN_VALUE_CENTS <= cents <= MAX_VALUE_CENTS else 0
+
+
+def item_value_cents(item) -> int:
+    """Numeric value of the item, parsed from text for items not migrated yet"""
+    if item.get("value_cents") is not None:
+        return item["value_cents"]
+    return value_cents(item.get("Value"))
+
+
+def search_condition(chat_id, max_value_cents: int = None, preowned_ids: list = None):
+    """
+    Items of other owners, which were never owned by the chat, optionally not more valuable than given value.
+    $ne on preowned_by can't use an index, so preowned items are looked up by the preowned_by index first
+    and excluded by preowned_ids, within bounds of the _id index pages are read by. Without ids the array is checked.
+    """
+    conditions = [{"chat_id": {"$nin": [None, chat_id]}}]  # exclude currently owned item
+    #exclude preowned items, maintained by trade_commit
+    if preowned_ids is None:
+        conditions.append({"preowned_by": {"$ne": chat_id}})
+    elif len(preowned_ids) > 0:
+        conditions.append({"_id": {"$nin": preowned_ids}})
+    if max_value_cents is not None:
+        conditions.append({"value_cents": {"$lte": max_value_cents}})  # items the chat can afford
+    return {"$and": conditions}
+
+
+# text score of $text queries, projected and sorted by
+TEXT_SCORE = {"score": {"$meta": "textScore"}}
+TEXT_SORT = [("score", {"$meta": "textScore"})]
+
+
+def text_search_condition(text: str, condition=None):
+    """Items matching words of the text, restricted by other condition"""
+    if condition is None:
+        return {"$text": {"$search": text}}
+    return {"$and": [condition, {"$text": {"$search": text}}]}
+
+
+def trade_timeline_pipeline(chat_id, offset: int, limit: int) -> list:
+    """One page of owner's outcoming trades joined with traded items, newest first, plus total count"""
+    return [
+        {"$match": {"from_chat_id": chat_id}},
+        {"$sort": {"trans_date": -1}},
+        {"$facet": {
+            "total": [{"$count": "count"}],
+            "page": [
+                {"$skip": offset},
+                {"$limit": limit},
+                {"$lookup": {"from": "items", "localField": "item_id", "foreignField": "_id", "as": "item"}},
+                {"$unwind": {"path": "$item", "preserveNullAndEmptyArrays": True}},
+                {"$project": {"item.Files": 0, "item.preowned_by": 0, "item.version": 0, "item.value_cents": 0,
+                              "item.categories": 0}},  # not shown in history
+            ],
+        }},
+    ]
+
+
+class TradeRejected(Exception):
+    """Trade failed validation, the message is shown to the user"""
+    pass
+
+
+# fields trade validation and swap need
+TRADE_FIELDS = {"_id": True, "chat_id": True, "Value": True, "value_cents": True, "Name": True,
+                "owner_name": True, "preowned_by": True, "version": True}
+
+
+def trade_swap(item, new_chat_id, new_owner_name) -> dict:
+    """
+    Update giving the item to the new owner. Filter matches only the version which was read,
+    items without version field match None.
+    """
+    return {
+        "filter": {"_id": item["_id"], "chat_id": item["chat_id"], "version": item.get("version")},
+        "update": {"$set": {"chat_id": new_chat_id, "owner_name": new_owner_name},
+                   "$addToSet": {"preowned_by": item["chat_id"]},
+                   "$inc": {"version": 1}},
+    }
+
+
+def execute_trade(client, db, chat_id, item_id,
+                  validate: Callable[[Optional[dict], Optional[dict]], str],
+                  owner_names: Dict[int, str] = None):
+    """
+    Swap owners of the chat's item and item_id in one transaction, returns both items as they were read.
+    Items are read and validated inside the transaction and updated only if their version is unchanged,
+    so a concurrent trade or edit either fails this one with write conflict, which with_transaction retries
+    from the start, or is rejected by validation of the fresh read.
+    validate(item1, item2) returns error message or "", raised as TradeRejected.
+    """
+    owner_names = owner_names or {}
+    items_coll = db["items"]
+    trans_coll = db["transactions"]
+
+    def trade(session):
+        item1 = items_coll.find_one({"chat_id": chat_id}, TRADE_FIELDS, session=session)
+        item2 = items_coll.find_one({"_id": ObjectId(item_id)}, TRADE_FIELDS, session=session)
+        error = validate(item1, item2)
+        if error != "":
+            raise TradeRejected(error)
+
+        name1 = owner_names.get(item1["chat_id"]) or item1.get("owner_name") or str(item1["chat_id"])
+        name2 = owner_names.get(item2["chat_id"]) or item2.get("owner_name") or str(item2["chat_id"])
+        for item, new_chat_id, new_name in [(item1, item2["chat_id"], name2), (item2, item1["chat_id"], name1)]:
+            result = items_coll.update_one(session=session, **trade_swap(item, new_chat_id, new_name))
+            if result.matched_count != 1:  # changed outside of the transaction snapshot
+                raise TradeRejected("❌Sorry, that item is not avaialable anymore!")
+
+        trans_date = datetime.now()
+        trans_coll.insert_many([
+            {"trans_date": trans_date, "item_id": item1["_id"],
+             "from_chat_id": item1["chat_id"], "from_name": name1,
+             "to_chat_id": item2["chat_id"], "to_name": name2},
+            {"trans_date": trans_date, "item_id": item2["_id"],
+             "from_chat_id": item2["chat_id"], "from_name": name2,
+             "to_chat_id": item1["chat_id"], "to_name": name1},
+        ], session=session)
+        return item1, item2
+
+    #https://pymongo.readthedocs.io/en/stable/api/pymongo/client_session.html#pymongo.client_session.ClientSession.with_transaction
+    #with_transaction retries on TransientTransactionError and UnknownTransactionCommitResult
+    with client.start_session() as session:
+        return session.with_transaction(trade,
+                                        read_concern=ReadConcern("snapshot"),
+                                        write_concern=WriteConcern("majority"),
+                                        read_preference=ReadPreference.PRIMARY)
+
+
+def ensure_indexes(db):
+    for coll_name, names in DROPPED_INDEXES.items():
+        existing = db[coll_name].index_information()
+        for name in names:
+            if name in existing:
+                db[coll_name].drop_index(name)
+    for coll_name, indexes in INDEXES.items():
+        db[coll_name].create_indexes(indexes)
+
+
+def query_plans(db) -> dict:
+    """explain() of every query bot2 and bot3 send, with sample parameters"""
+    chat_id = 0
+    item_id = ObjectId()
+    items = db["items"]
+    return {
+        "items by chat_id": items.find({"chat_id": chat_id}).explain(),
+        "items by _id and chat_id": items.find({"_id": item_id, "chat_id": chat_id}).explain(),
+        "items by _id and owner_id": items.find({"_id": item_id, "owner_id": chat_id}).explain(),
+        "items by owner_id sorted by Name": items.find({"owner_id": chat_id}).sort("Name").explain(),
+        "preowned items": items.find({"preowned_by": chat_id}, {"_id": True}).explain(),
+        "search page": items.find({"$and": [search_condition(chat_id, 0, [item_id]), {"_id": {"$gt": item_id}}]})
+            .sort("_id", ASCENDING).limit(6).explain(),
+        "search count": db.command("explain", {"count": "items", "query": search_condition(chat_id, 0, [item_id])}),
+        "text search": items.find(text_search_condition("item", search_condition(chat_id, 0, [item_id])), TEXT_SCORE)
+            .sort(TEXT_SORT).limit(100).explain(),
+        "trades history": db.command("aggregate", "transactions",
+            pipeline=trade_timeline_pipeline(chat_id, 0, 5), explain=True),
+    }
+
+
+def find_stages(plan, stage: str) -> list:
+    """All nested plan nodes with given stage name"""
+    found = []
+    if isinstance(plan, dict):
+        if plan.get("stage") == stage:
+            found.append(plan)
+        for value in plan.values():
+            found += find_stages(value, stage)
+    elif isinstance(plan, list):
+        for value in plan:
+            found += find_stages(value, stage)
+    return found
+
+
+def check_query_plans(db) -> list:
+    """Names of queries falling back to collection scan"""
+    return [name for name, plan in query_plans(db).items() if find_stages(plan, "COLLSCAN")]
+
+
+def backfill_preowned(db) -> int:
+    """
+    Fill items' 'preowned_by' lists from transactions recorded before trade_commit maintained them.
+    Safe to run many times, owners are added to sets.
+    """
+    pipeline = [{"$group": {"_id": "$item_id", "owners": {"$addToSet": "$from_chat_id"}}}]
+    requests = [UpdateOne({"_id": row["_id"]}, {"$addToSet": {"preowned_by": {"$each": row["owners"]}}})
+                for row in db["transactions"].aggregate(pipeline)]
+    if len(requests) == 0:
+        return 0
+    return db["items"].bulk_write(requests, ordered=False).modified_count
+
+
+def migrate_values(db, batch_size: int = 1000) -> int:
+    """Set value_cents of items which have only text Value. Safe to run many times."""
+    updated = 0
+    requests = []
+    for item in db["items"].find({"value_cents": {"$exists": False}}, {"Value": True}):
+        requests.append(UpdateOne({"_id": item["_id"], "value_cents": {"$exists": False}},
+                                  {"$set": {"value_cents": value_cents(item.get("Value"))}}))
+        if len(requests) == batch_size:
+            updated += db["items"].bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if len(requests) > 0:
+        updated += db["items"].bulk_write(requests, ordered=False).modified_count
+    return updated
+
+
+def migrate_categories(db, batch_size: int = 1000) -> int:
+    """Set text of custom categories of items saved before it was indexed. Safe to run many times."""
+    updated = 0
+    requests = []
+    for item in db["items"].find({"categories": {"$exists": False}}):
+        requests.append(UpdateOne({"_id": item["_id"], "categories": {"$exists": False}},
+                                  {"$set": {"categories": categories_text(item)}}))
+        if len(requests) == batch_size:
+            updated += db["items"].bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if len(requests) > 0:
+        updated += db["items"].bulk_write(requests, ordered=False).modified_count
+    return updated
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="botDB maintenance")
+    parser.add_argument("command", choices=["ensure-indexes", "check-indexes", "backfill-preowned", "migrate-values",
+                                            "migrate-categories"])
+    args = parser.parse_args(argv)
+
+    db = get_db()
+    if args.command == "ensure-indexes":
+        ensure_indexes(db)
+    elif args.command == "check-indexes":
+        ensure_indexes(db)
+        failed = check_query_plans(db)
+        for name in failed:
+            print(f"COLLSCAN: {name}")
+        if failed:
+            return 1
+        print("All queries use indexes")
+    elif args.command == "backfill-preowned":
+        print(f"{backfill_preowned(db)} item(s) updated")
+    elif args.command == "migrate-values":
+        print(f"{migrate_values(db)} item(s) updated")
+    elif args.command == "migrate-categories":
+        print(f"{migrate_categories(db)} item(s) updated")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+Downloads of users' photos and files.
+Sizes are checked from message metadata before get_file, files are streamed to disk
+by a few threads sharing one pool of HTTP connections.
+"""
+import os
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from telegram import PhotoSize
+
+import constants as C
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+def best_photo_size(photo_sizes: List[PhotoSize], max_bytes: int) -> Optional[PhotoSize]:
+    """Telegram sends every photo in several resolutions, take the largest one within size limit"""
+    allowed = [p for p in photo_sizes if p.file_size is None or p.file_size <= max_bytes]
+    return max(allowed, key=lambda p: p.width * p.height, default=None)
+
+
+class Downloader:
+    def __init__(self, workers: int = C.DOWNLOAD_WORKERS, timeout: float = C.DOWNLOAD_TIMEOUT):
+        self.timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+        self._lock = threading.Lock()
+        self._futures: Dict[str, Future] = {}  # destination path -> future
+
+    def submit(self, attachment, path: str, max_bytes: int, then: Callable[[str], None] = None) -> Future:
+        """
+        Download PhotoSize or Document to path in background. 'then' is called with the path in download thread
+        before future completes. Raises FileTooLarge without any request if metadata size is over the limit.
+        """
+        if attachment.file_size is not None and attachment.file_size > max_bytes:
+            raise FileTooLarge(f"{attachment.file_size} bytes, limit is {max_bytes}")
+        future = self._executor.submit(self._download, attachment, path, max_bytes, then)
+        with self._lock:
+            self._futures[path] = future
+        future.add_done_callback(lambda f: self._done(path, f))
+        return future
+
+    def _done(self, path: str, future: Future):
+        with self._lock:
+            if self._futures.get(path) is future:
+                del self._futures[path]
+        if future.exception() is not None:
+            logger.warning(f"Download of {path} failed: {future.exception()}")
+
+    def _download(self, attachment, path: str, max_bytes: int, then: Callable[[str], None] = None) -> str:
+        file = attachment.get_file()  # file_path is full download url
+        part_path = path + ".part"
+        size = 0
+        with self._session.get(file.file_path, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            with open(part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        f.close()
+                        os.remove(part_path)
+                        raise FileTooLarge(f"more than {max_bytes} bytes")
+                    f.write(chunk)
+        os.replace(part_path, path)
+        if then is not None:
+            then(path)
+        return path
+
+    def wait(self, paths: Iterable[str], timeout: Optional[float] = None):
+        """Wait for downloads still in progress, failures are logged"""
+        with self._lock:
+            futures = [self._futures[p] for p in paths if p in self._futures]
+        for future in futures:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass  # logged by _done
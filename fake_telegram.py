@@ -0,0 +1,135 @@
+"""
+Local fake of Telegram for the webhook front end: Bot API server answering every method without network,
+and sender of updates to the webhook, like Telegram delivers them.
+
+Usage, with C.TELEGRAM_BASE_URL = "http://localhost:8081/bot":
+python fake_telegram.py --port 8081
+PORT=8443 python bot3.py
+python fake_telegram.py --webhook http://localhost:8443/<token> --chats 50 --updates 20
+
+Every chat sends /help updates one after another, rejected ones are redelivered after Retry-After
+as Telegram does. Prints accepted updates per second and the number of 503 answers.
+"""
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from itertools import count
+from http.server import BaseHTTPRequestHandler
+
+import webhook
+
+_message_ids = count(1000)
+
+
+def answer(method: str, data: dict):
+    """Result of Bot API method, messages get new ids in the chat of the request"""
+    chat_id = int(data.get('chat_id', 1)) if data else 1
+    if method == 'getMe':
+        return {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}
+    if method == 'getChat':
+        return {'id': chat_id, 'type': 'private', 'first_name': f'user{chat_id}'}
+    if method == 'getUpdates':  # updates come only through the webhook, long poll ends empty
+        time.sleep(float(data.get('timeout', 0)))
+        return []
+    message = {'message_id': next(_message_ids), 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}}
+    if method == 'sendMediaGroup':
+        return [dict(message, message_id=next(_message_ids)) for _ in data.get('media', [])]
+    if method.startswith('send') or method.startswith('edit'):
+        return message
+    return True
+
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            data = json.loads(body or b"{}")
+        else:  # multipart upload, only chat id is needed
+            chat_id = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+            data = {'chat_id': int(chat_id.group(1))} if chat_id else {}
+        payload = json.dumps({'ok': True, 'result': answer(method, data)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def help_update(update_id: int, chat_id: int) -> dict:
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': '/help',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}}}
+
+
+def deliver(webhook: str, update: dict, secret_token: str, rejected: list) -> None:
+    """Post update until the webhook accepts it"""
+    request_headers = {"Content-Type": "application/json"}
+    if secret_token:
+        request_headers["X-Telegram-Bot-Api-Secret-Token"] = secret_token
+    body = json.dumps(update).encode()
+    while True:
+        try:
+            urllib.request.urlopen(urllib.request.Request(webhook, body, request_headers)).close()
+            return
+        except urllib.error.HTTPError as e:
+            if e.code not in (429, 503):
+                raise
+            rejected.append(e.code)
+            time.sleep(float(e.headers.get("Retry-After", 1)))
+
+
+def send_updates(webhook: str, chats: int, updates: int, secret_token: str = "") -> None:
+    update_ids = count(1)
+    lock = threading.Lock()
+    rejected = []
+
+    def chat(chat_id: int):
+        for _ in range(updates):
+            with lock:
+                update_id = next(update_ids)
+            deliver(webhook, help_update(update_id, chat_id), secret_token, rejected)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=chat, args=(chat_id,)) for chat_id in range(1, chats + 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    print(f"{chats * updates} updates accepted in {elapsed:.1f}s, {chats * updates / elapsed:.1f} updates/s, "
+          f"{len(rejected)} redeliveries after busy answer")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="fake Telegram: Bot API server and webhook update sender")
+    parser.add_argument("--port", type=int, help="serve the fake Bot API on this port")
+    parser.add_argument("--webhook", help="send updates to this webhook url")
+    parser.add_argument("--secret-token", default="")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=20, help="updates per chat")
+    args = parser.parse_args(argv)
+
+    if args.webhook:
+        send_updates(args.webhook, args.chats, args.updates, args.secret_token)
+    if args.port:
+        server = webhook.WebhookServer(("127.0.0.1", args.port), BotApiHandler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
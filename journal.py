@@ -0,0 +1,146 @@
+"""
+Trade journal of bot1 kept in SQLite database in WAL mode.
+Every committed trade appends one row with the item in TradeItem string format,
+the current bot item is the last row. Rows are indexed by owner and by the trade date parsed to ISO format,
+so date ranges compare as text whatever format TradeItem.Date was written in.
+References of the items to uploaded blobs are counted in the same transaction as the trade,
+so garbage collection looks names up instead of reading the whole journal.
+"""
+import csv
+import os
+import sqlite3
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional
+
+import trade_types as T
+
+# formats of TradeItem.Date, the first one is the one bot1 writes
+DATE_FORMATS = ("%d/%m/%y %H:%M:%S", "%d/%m/%y", "%d/%m/%Y %H:%M:%S", "%d/%m/%Y")
+
+
+def traded_at(date: str) -> Optional[str]:
+    """TradeItem.Date in ISO format, None if it can't be parsed"""
+    date = str(date).strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(date, date_format).isoformat()
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(date).isoformat()
+    except ValueError:
+        return None
+
+
+class Journal:
+    def __init__(self, path: str, blob_names: Callable[[T.TradeItem], Iterable[str]] = None):
+        """blob_names gives names of uploaded blobs the item refers to"""
+        self.path = path
+        self.blob_names = blob_names or (lambda item: ())
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS trades ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " owner TEXT,"
+            " date TEXT,"
+            " item TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS trades_owner ON trades (owner, id)")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(trades)")]
+        if "traded_at" not in columns:  # journal written before dates were parsed
+            self._write(self._add_traded_at)
+        counted = self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'blobs'").fetchone()
+        self._conn.execute("CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, refs INTEGER NOT NULL)")
+        if counted is None:  # journal written before references were counted
+            self._write(lambda: self._add_refs(T.TradeItem(row[0]) for row in
+                                               self._conn.execute("SELECT item FROM trades").fetchall()))
+
+    def _write(self, write: Callable[[], object]):
+        """Run write in one transaction, caller holds the lock or is the constructor"""
+        self._conn.execute("BEGIN")
+        try:
+            result = write()
+            self._conn.execute("COMMIT")
+            return result
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def _add_traded_at(self):
+        self._conn.execute("ALTER TABLE trades ADD COLUMN traded_at TEXT")
+        self._conn.execute("DROP INDEX IF EXISTS trades_date")
+        self._conn.execute("CREATE INDEX trades_traded_at ON trades (traded_at)")
+        self._conn.executemany("UPDATE trades SET traded_at = ? WHERE id = ?",
+                               [(traded_at(date), row_id) for row_id, date in
+                                self._conn.execute("SELECT id, date FROM trades").fetchall()])
+
+    def _add_refs(self, items: Iterable[T.TradeItem]):
+        refs = Counter(name for item in items for name in self.blob_names(item) if name != "")
+        self._conn.executemany("INSERT INTO blobs (name, refs) VALUES (?, ?)"
+                               " ON CONFLICT (name) DO UPDATE SET refs = refs + excluded.refs", refs.items())
+
+    def append(self, item: T.TradeItem) -> int:
+        def write():
+            self._add_refs([item])
+            return self._conn.execute("INSERT INTO trades (owner, date, traded_at, item) VALUES (?, ?, ?, ?)",
+                                      (str(item.Owner), str(item.Date), traded_at(item.Date),
+                                       item.to_string())).lastrowid
+        with self._lock:
+            return self._write(write)
+
+    def referenced(self, name: str) -> bool:
+        """Blob is referenced by a journal item"""
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM blobs WHERE name = ? AND refs > 0", (name,)).fetchone() is not None
+
+    def last(self) -> Optional[T.TradeItem]:
+        """Current bot item, or None for empty journal"""
+        with self._lock:
+            row = self._conn.execute("SELECT item FROM trades ORDER BY id DESC LIMIT 1").fetchone()
+        return T.TradeItem(row[0]) if row else None
+
+    def by_owner(self, owner: str, limit: int = 100) -> List[T.TradeItem]:
+        """Latest items traded by the owner"""
+        with self._lock:
+            rows = self._conn.execute("SELECT item FROM trades WHERE owner = ? ORDER BY id DESC LIMIT ?",
+                                      (owner, limit)).fetchall()
+        return [T.TradeItem(row[0]) for row in rows]
+
+    def by_date(self, date_from: datetime, date_to: datetime) -> List[T.TradeItem]:
+        """Items traded in the date range including both ends, items with unparsable dates are skipped"""
+        with self._lock:
+            rows = self._conn.execute("SELECT item FROM trades WHERE traded_at >= ? AND traded_at <= ?"
+                                      " ORDER BY traded_at, id",
+                                      (date_from.isoformat(), date_to.isoformat())).fetchall()
+        return [T.TradeItem(row[0]) for row in rows]
+
+    def all(self) -> List[T.TradeItem]:
+        with self._lock:
+            rows = self._conn.execute("SELECT item FROM trades ORDER BY id").fetchall()
+        return [T.TradeItem(row[0]) for row in rows]
+
+    def import_csv(self, csv_path: str) -> int:
+        """Move trades of old journal.csv into empty journal, the csv file is renamed afterwards"""
+        if not os.path.isfile(csv_path):
+            return 0
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM trades LIMIT 1").fetchone() is not None:
+                return 0
+        # the csv module takes both \n and \r\n line ends, rows of old journals written on Windows end with \r\n
+        with open(csv_path, 'r', encoding='utf-8', newline='') as j:
+            rows = list(csv.reader(j, delimiter='|', quoting=csv.QUOTE_NONE))[1:]  # skip header
+        lines = ["|".join(row) for row in rows if "".join(row).strip() != ""]
+        items = [T.TradeItem(line) for line in lines]
+        def write():
+            self._add_refs(items)
+            self._conn.executemany("INSERT INTO trades (owner, date, traded_at, item) VALUES (?, ?, ?, ?)",
+                                   [(str(item.Owner), str(item.Date), traded_at(item.Date), line)
+                                    for item, line in zip(items, lines)])
+        with self._lock:
+            self._write(write)
+        os.rename(csv_path, csv_path + ".imported")
+        return len(items)
@@ -0,0 +1,54 @@
+"""
+Sending item photos as albums.
+Item 'Images' is a string of file ids separated by '|', every 10 of them go as one media group.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from telegram import InputMediaPhoto
+from telegram.error import TelegramError
+
+import constants as C
+
+logger = logging.getLogger(__name__)
+
+MEDIA_GROUP_SIZE = 10  # Bot API limit of send_media_group
+
+
+def image_ids(images) -> List[str]:
+    return [image_id for image_id in str(images or "").split('|') if image_id != ""]
+
+
+class MediaRenderer:
+    def __init__(self, max_workers: int = C.MEDIA_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='media')
+
+    def send_images(self, bot, chat_id, images, reply_to_message_id=None, caption="Attached image") -> List[int]:
+        """Send item images replying to item message, returns ids of sent messages"""
+        ids = image_ids(images)
+        message_ids = []
+        for start in range(0, len(ids), MEDIA_GROUP_SIZE):
+            chunk = ids[start:start + MEDIA_GROUP_SIZE]
+            try:
+                if (len(chunk) == 1):  # media group must have 2-10 items
+                    messages = [bot.send_photo(chat_id=chat_id, photo=chunk[0], caption=caption,
+                                               reply_to_message_id=reply_to_message_id)]
+                else:
+                    media = [InputMediaPhoto(media=chunk[0], caption=caption)]
+                    media += [InputMediaPhoto(media=image_id) for image_id in chunk[1:]]
+                    messages = bot.send_media_group(chat_id=chat_id, media=media,
+                                                    reply_to_message_id=reply_to_message_id)
+                message_ids += [message.message_id for message in messages]
+            except TelegramError as e:
+                logger.warning(f"Could not send {len(chunk)} image(s) to chat {chat_id}: {e}")
+        return message_ids
+
+    def render(self, bot, chat_id, albums: List[Tuple[str, int]]) -> List[int]:
+        """Send images of several items concurrently, albums are pairs of (images, reply to message id)"""
+        futures = [self._executor.submit(self.send_images, bot, chat_id, images, reply_to)
+                   for images, reply_to in albums if len(image_ids(images)) > 0]
+        message_ids = []
+        for future in futures:
+            message_ids += future.result()
+        return message_ids
@@ -0,0 +1,41 @@
+"""
+Process-wide counters and timings of the bot.
+Counters are plain numbers, observations keep count, total and maximum of measured values.
+"""
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_observations = {}
+
+
+def increment(name: str, value: int = 1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, value: float):
+    with _lock:
+        count, total, maximum = _observations.get(name, (0, 0.0, 0.0))
+        _observations[name] = (count + 1, total + value, max(maximum, value))
+
+
+def snapshot() -> Dict[str, float]:
+    """Copy of all counters, observations are reported as name.count, name.avg and name.max"""
+    with _lock:
+        result = dict(_counters)
+        for name, (count, total, maximum) in _observations.items():
+            result[f"{name}.count"] = count
+            result[f"{name}.avg"] = total / count if count else 0.0
+            result[f"{name}.max"] = maximum
+    return result
+
+
+def log_snapshot(context=None):
+    """Job callback writing all metrics to the log"""
+    logger.info("metrics: " + ", ".join(f"{name}={value:g}" for name, value in sorted(snapshot().items())))
@@ -0,0 +1,205 @@
+"""
+Flood control of Bot API requests. Telegram answers 429 (RetryAfter) to a bot sending more than about
+30 messages per second overall, more than a message per second to one chat for long or 20 messages per minute
+to one group. Short bursts to a chat are allowed, budgets are sized in constants.
+Messages wait for budget of their chat and the global budget before they are sent, deletions wait for the global
+budget only. RetryAfter holds the chat back for the time Telegram asks and the request is sent again.
+Plain text messages to a chat which pile up while waiting for budget go as one message.
+Budgets are kept per process.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from telegram.utils.helpers import DEFAULT_NONE
+
+import constants as C
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096  # Bot API limit of message text
+TEXT_SEPARATOR = "\n\n"
+# options which must be the same for merged text messages, other options (markup, reply) are never merged
+MERGE_OPTIONS = ('parse_mode', 'disable_web_page_preview', 'disable_notification', 'protect_content')
+
+
+def chat_limited(endpoint: str) -> bool:
+    """Methods posting to a chat"""
+    return endpoint.startswith(('send', 'edit', 'copy', 'forward'))
+
+
+def globally_limited(endpoint: str) -> bool:
+    return chat_limited(endpoint) or endpoint.startswith('delete') and endpoint != 'deleteWebhook'
+
+
+def merge_key(endpoint: str, data: dict) -> Optional[tuple]:
+    """Options of a plain text message which can be merged with others of the same key, None for other requests"""
+    if (endpoint != 'sendMessage'):
+        return None
+    if any(value is not None for key, value in data.items() if key not in MERGE_OPTIONS and key not in ('chat_id', 'text')):
+        return None
+    return tuple(repr(data.get(option)) for option in MERGE_OPTIONS)
+
+
+class TokenBucket:
+    """Budget of rate requests per second with bursts up to burst, callers take their turn by reservation"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        """Takes a token, returns seconds to wait until it's available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+        self.updated = now
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+
+
+class _Batch:
+    """Text messages to one chat sent as one message, the first sender sends it and the others wait for it"""
+
+    __slots__ = ('key', 'data', 'texts', 'length', 'done', 'result', 'error')
+
+    def __init__(self, key: tuple, data: dict):
+        self.key = key
+        self.data = data
+        self.texts = [data['text']]
+        self.length = len(data['text'])
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def fits(self, key: tuple, text: str) -> bool:
+        return key == self.key and self.length + len(TEXT_SEPARATOR) + len(text) <= MAX_MESSAGE_LENGTH
+
+    def add(self, text: str):
+        self.texts.append(text)
+        self.length += len(TEXT_SEPARATOR) + len(text)
+
+
+class OutboundLimiter:
+    def __init__(self, global_rate: float = C.OUTBOUND_GLOBAL_RATE, global_burst: float = C.OUTBOUND_GLOBAL_BURST,
+                 chat_rate: float = C.OUTBOUND_CHAT_RATE, chat_burst: float = C.OUTBOUND_CHAT_BURST,
+                 group_rate: float = C.OUTBOUND_GROUP_RATE, group_burst: float = C.OUTBOUND_GROUP_BURST,
+                 max_retries: int = C.OUTBOUND_MAX_RETRIES, max_chats: int = C.OUTBOUND_MAX_CHATS):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._lock = threading.Lock()
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = OrderedDict()  # chat id -> TokenBucket, least recently used first
+        self._pending = {}  # chat id -> _Batch of text messages waiting for budget
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            group = isinstance(chat_id, str) or chat_id < 0  # groups and channels have negative ids or @username
+            bucket = TokenBucket(self.group_rate, self.group_burst) if group else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _wait(self, endpoint: str, chat_id):
+        """Sleep until the chat and then the global budget allow the request"""
+        waited = 0.0
+        if (chat_id is not None):
+            with self._lock:
+                wait = self._chat_bucket(chat_id).reserve(time.monotonic())
+            time.sleep(wait)
+            waited += wait
+        if globally_limited(endpoint):
+            with self._lock:
+                wait = self._global.reserve(time.monotonic())
+            time.sleep(wait)
+            waited += wait
+        metrics.observe("outbound.wait", waited)
+
+    def _send(self, endpoint: str, chat_id, data: dict, send: Callable[[dict], object],
+              prepare: Callable[[], dict] = None):
+        """Send after waiting for budget, again after RetryAfter up to max_retries times"""
+        for attempt in range(self.max_retries + 1):
+            self._wait(endpoint, chat_id)
+            if prepare is not None:
+                data = prepare()
+            try:
+                return send(data)
+            except RetryAfter as e:
+                metrics.increment("outbound.retry_after")
+                logger.warning(f"{endpoint} to chat {chat_id} must wait {e.retry_after}s, attempt {attempt + 1}")
+                if (attempt == self.max_retries):
+                    raise
+                with self._lock:
+                    bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                    bucket.block(time.monotonic() + e.retry_after)
+
+    def _send_merged(self, chat_id, key: tuple, data: dict, send: Callable[[dict], object]):
+        with self._lock:
+            batch = self._pending.get(chat_id)
+            merged = batch is not None and batch.fits(key, data['text'])
+            if merged:
+                batch.add(data['text'])
+            else:  # this sender sends the batch
+                batch = _Batch(key, data)
+                self._pending[chat_id] = batch
+        if merged:
+            metrics.increment("outbound.merged")
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.result
+
+        def prepare() -> dict:
+            # texts added until the budget allowed sending go with it, later ones start a new batch
+            with self._lock:
+                if self._pending.get(chat_id) is batch:
+                    del self._pending[chat_id]
+                return dict(batch.data, text=TEXT_SEPARATOR.join(batch.texts))
+
+        try:
+            batch.result = self._send('sendMessage', chat_id, data, send, prepare)
+            return batch.result
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
+
+    def call(self, endpoint: str, data: dict, send: Callable[[dict], object]):
+        """Result of send(data) once budgets allow it"""
+        chat_id = data.get('chat_id') if chat_limited(endpoint) else None
+        key = merge_key(endpoint, data) if chat_id is not None else None
+        if key is not None:
+            return self._send_merged(chat_id, key, data, send)
+        return self._send(endpoint, chat_id, data, send)
+
+
+class RateLimitedBot(ExtBot):
+    """Bot whose requests go through an OutboundLimiter"""
+
+    def __init__(self, *args, limiter: OutboundLimiter = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter or OutboundLimiter()
+
+    def _post(self, endpoint: str, data: dict = None, timeout=DEFAULT_NONE, api_kwargs: dict = None):
+        data = dict(data or {}, **(api_kwargs or {}))
+        return self.limiter.call(endpoint, data, lambda data: super(RateLimitedBot, self)._post(endpoint, data, timeout))
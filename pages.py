@@ -0,0 +1,139 @@
+"""
+Bounded bookkeeping of bot3 pages: ids of messages to delete when the next page is shown,
+and items of trade buttons by message id. Both keep a fixed number of entries and forget
+entries older than max age, so long-lived chats don't grow them forever.
+"""
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+
+import constants as C
+
+
+class MessageRing:
+    """Fixed-size ring of message ids, appending to a full ring overwrites the oldest id"""
+
+    __slots__ = ('_ids', '_times', '_start', '_size')
+
+    def __init__(self, capacity: int = C.PAGE_MESSAGES_CAPACITY):
+        self._ids = array('q', [0]) * capacity
+        self._times = array('d', [0.0]) * capacity  # wall clock, entries outlive restarts with persistence
+        self._start = 0
+        self._size = 0
+
+    def append(self, message_id: int):
+        capacity = len(self._ids)
+        end = (self._start + self._size) % capacity
+        self._ids[end] = message_id
+        self._times[end] = time.time()
+        if self._size < capacity:
+            self._size += 1
+        else:
+            self._start = (self._start + 1) % capacity
+
+    def extend(self, message_ids: Iterable[int]):
+        for message_id in message_ids:
+            self.append(message_id)
+
+    def drain(self) -> List[int]:
+        """All ids, oldest first, the ring is empty afterwards"""
+        message_ids = list(self)
+        self._start = 0
+        self._size = 0
+        return message_ids
+
+    def evict(self, max_age: float) -> int:
+        """Forget ids older than max_age seconds, returns number of forgotten ids"""
+        expiry = time.time() - max_age
+        evicted = 0
+        while self._size > 0 and self._times[self._start] < expiry:
+            self._start = (self._start + 1) % len(self._ids)
+            self._size -= 1
+            evicted += 1
+        return evicted
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self._ids) + sys.getsizeof(self._times)
+
+    def __iter__(self):
+        capacity = len(self._ids)
+        for i in range(self._size):
+            yield self._ids[(self._start + i) % capacity]
+
+    def __len__(self) -> int:
+        return self._size
+
+
+class PageItems:
+    """Item ids by message id of their trade button, the oldest entries are dropped over capacity"""
+
+    __slots__ = ('capacity', '_items')
+
+    def __init__(self, capacity: int = C.PAGE_ITEMS_CAPACITY):
+        self.capacity = capacity
+        self._items = OrderedDict()  # message id -> (item id, time added)
+
+    def __setitem__(self, message_id: int, item_id):
+        self._items[message_id] = (item_id, time.time())
+        self._items.move_to_end(message_id)
+        while len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+    def __getitem__(self, message_id: int):
+        return self._items[message_id][0]
+
+    def __delitem__(self, message_id: int):
+        del self._items[message_id]
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def evict(self, max_age: float) -> int:
+        """Forget entries older than max_age seconds, returns number of forgotten entries"""
+        expiry = time.time() - max_age
+        evicted = 0
+        while self._items and next(iter(self._items.values()))[1] < expiry:
+            self._items.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self._items) + \
+            sum(sys.getsizeof(key) + sys.getsizeof(value) + sys.getsizeof(value[0]) for key, value in self._items.items())
+
+
+def messages_of(data: dict, key) -> MessageRing:
+    """Ring stored in chat_data under key, created on first use, older entries evicted"""
+    ring = data.get(key)
+    if not isinstance(ring, MessageRing):
+        previous = ring or []  # list of ids saved before rings were used
+        ring = MessageRing()
+        ring.extend(previous)
+        data[key] = ring
+    ring.evict(C.PAGE_STATE_MAX_AGE)
+    return ring
+
+
+def items_of(data: dict, key) -> PageItems:
+    """Page items stored in user_data under key, created on first use, older entries evicted"""
+    items = data.get(key)
+    if not isinstance(items, PageItems):
+        previous = items or {}  # dict saved before PageItems were used
+        items = PageItems()
+        for message_id, item_id in previous.items():
+            items[message_id] = item_id
+        data[key] = items
+    items.evict(C.PAGE_STATE_MAX_AGE)
+    return items
+
+
+def usage(data_by_id: dict, key) -> Tuple[int, int, int]:
+    """Number of structures stored under key in user_data/chat_data of the dispatcher, their entries and bytes"""
+    structures = [data.get(key) for data in list(data_by_id.values())]
+    structures = [s for s in structures if isinstance(s, (MessageRing, PageItems))]
+    return len(structures), sum(len(s) for s in structures), sum(s.nbytes() for s in structures)
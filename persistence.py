@@ -0,0 +1,231 @@
+"""
+Conversation persistence of the bots which survives restarts.
+Only entries changed since the last flush are written, one row per user, chat or conversation,
+in batches on an interval. Entries are read back on first access, so start up does not depend
+on the number of stored chats.
+"""
+import json
+import pickle
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Optional, Tuple
+
+from bson.binary import Binary
+from pymongo import DeleteOne, UpdateOne
+from telegram.ext import BasePersistence, CallbackContext
+from telegram.ext.utils.promise import Promise
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = "user_data"
+CHAT_DATA = "chat_data"
+CONVERSATIONS = "conversations"
+
+
+class SQLiteStore:
+    """Entries in a SQLite table, for bot1 which keeps its data in files"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS persistence ("
+            " kind TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " PRIMARY KEY (kind, key))")
+
+    def load(self, kind: str, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM persistence WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row else None
+
+    def save(self, entries: Dict[Tuple[str, str], Optional[bytes]]):
+        """Write entries in one transaction, None value deletes the entry"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO persistence (kind, key, value) VALUES (?, ?, ?)",
+                                       [(kind, key, value) for (kind, key), value in entries.items() if value is not None])
+                self._conn.executemany("DELETE FROM persistence WHERE kind = ? AND key = ?",
+                                       [(kind, key) for (kind, key), value in entries.items() if value is None])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+
+class MongoStore:
+    """Entries in a Mongo collection, for bot2 and bot3"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def load(self, kind: str, key: str) -> Optional[bytes]:
+        doc = self.collection.find_one({"_id": f"{kind}:{key}"}, {"value": True})
+        return bytes(doc["value"]) if doc else None
+
+    def save(self, entries: Dict[Tuple[str, str], Optional[bytes]]):
+        """Write entries in one unordered bulk, None value deletes the entry"""
+        requests = [UpdateOne({"_id": f"{kind}:{key}"}, {"$set": {"value": Binary(value)}}, upsert=True)
+                    if value is not None else DeleteOne({"_id": f"{kind}:{key}"})
+                    for (kind, key), value in entries.items()]
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+
+class LazyData(defaultdict):
+    """user_data/chat_data of the dispatcher, entry is loaded from the store when it's used first time"""
+
+    def __init__(self, load: Callable[[int], dict]):
+        super().__init__(dict)
+        self._load = load
+
+    def __missing__(self, key):
+        value = self._load(key)
+        self[key] = value
+        return value
+
+
+class LazyConversations(dict):
+    """States of one ConversationHandler, loaded from the store on first lookup of a conversation"""
+
+    def __init__(self, load: Callable[[tuple], Optional[object]]):
+        super().__init__()
+        self._load = load
+        self._lock = threading.Lock()
+        self._checked = set()  # keys looked up in the store already
+
+    def _ensure(self, key):
+        with self._lock:
+            if key in self._checked:
+                return
+            self._checked.add(key)
+        state = self._load(key)
+        if state is not None:
+            self.setdefault(key, state)
+
+    def get(self, key, default=None):
+        self._ensure(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self._ensure(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self._ensure(key)
+        return super().__getitem__(key)
+
+
+class BatchedPersistence(BasePersistence):
+    """
+    Persistence of user_data, chat_data and conversations in a store. Dispatcher reports every changed entry,
+    they are pickled one by one and written by flush(), entries with unchanged pickle are skipped.
+    Data is kept as is, the bots don't put Bot instances into it.
+    user_data_to_save returns user_data without expired entries, which are not written.
+    """
+
+    def __init__(self, store, user_data_to_save: Callable[[dict], dict] = None):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=False)
+        self.store = store
+        self.user_data_to_save = user_data_to_save
+        self._lock = threading.Lock()
+        self._dirty: Dict[Tuple[str, str], object] = {}  # (kind, key) -> data to save, None to delete
+        self._digests: Dict[Tuple[str, str], bytes] = {}  # (kind, key) -> digest of saved pickle
+
+    def insert_bot(self, obj):
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def _load(self, kind: str, key: str):
+        try:
+            value = self.store.load(kind, key)
+        except Exception as e:
+            logger.warning(f"Could not load {kind} {key}: {e}")
+            return None
+        if value is None:
+            return None
+        self._digests[(kind, key)] = hashlib.blake2b(value, digest_size=8).digest()
+        return pickle.loads(value)
+
+    def _mark(self, kind: str, key: str, data):
+        with self._lock:
+            self._dirty[(kind, key)] = data
+
+    def get_user_data(self):
+        return LazyData(lambda user_id: self._load(USER_DATA, str(user_id)) or {})
+
+    def get_chat_data(self):
+        return LazyData(lambda chat_id: self._load(CHAT_DATA, str(chat_id)) or {})
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name: str):
+        return LazyConversations(lambda key: self._load(f"{CONVERSATIONS}:{name}", json.dumps(list(key))))
+
+    def update_user_data(self, user_id: int, data: dict):
+        self._mark(USER_DATA, str(user_id), data if data else None)
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        self._mark(CHAT_DATA, str(chat_id), data if data else None)
+
+    def update_bot_data(self, data):
+        pass
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]):
+        if isinstance(new_state, tuple) and len(new_state) == 2 and isinstance(new_state[1], Promise):
+            new_state = new_state[0]  # state before the handler still running, its result is reported later
+        self._mark(f"{CONVERSATIONS}:{name}", json.dumps(list(key)), new_state)
+
+    def flush(self):
+        """Write entries changed since the last flush"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        entries = {}
+        digests = {}
+        for key, data in dirty.items():
+            if (data is not None and key[0] == USER_DATA and self.user_data_to_save is not None):
+                data = self.user_data_to_save(data) or None
+            if data is None:
+                if key in self._digests:
+                    entries[key] = None
+                    digests[key] = None
+                continue
+            try:
+                value = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            except RuntimeError:  # changed by a handler running meanwhile, next flush gets it
+                self._mark(key[0], key[1], data)
+                continue
+            digest = hashlib.blake2b(value, digest_size=8).digest()
+            if self._digests.get(key) != digest:
+                entries[key] = value
+                digests[key] = digest
+        if not entries:
+            return
+        try:
+            self.store.save(entries)
+        except Exception as e:
+            logger.warning(f"Could not save {len(entries)} persistence entries: {e}")
+            with self._lock:
+                for key, data in dirty.items():
+                    self._dirty.setdefault(key, data)
+            return
+        for key, digest in digests.items():
+            if digest is None:
+                self._digests.pop(key, None)
+            else:
+                self._digests[key] = digest
+
+    def flush_job(self, context: CallbackContext):
+        """Job callback flushing on an interval"""
+        self.flush()
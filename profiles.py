@@ -0,0 +1,69 @@
+"""
+Owners' display names for search and history pages.
+Names are fetched with get_chat only for chat ids which are not cached yet,
+all missing ids of the page are fetched concurrently.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable
+
+from telegram import Chat
+from telegram.error import TelegramError
+
+import constants as C
+
+logger = logging.getLogger(__name__)
+
+
+def chat_display_name(chat: Chat, chat_id=None) -> str:
+    """username if defined, otherwise first and last name, otherwise chat id"""
+    if (chat.username is not None and chat.username != "None"):
+        return chat.username
+    elif (chat.first_name is not None and chat.first_name != "None"):
+        return f"{chat.first_name} {chat.last_name}"
+    return str(chat_id if chat_id is not None else chat.id)
+
+
+class ProfileCache:
+    def __init__(self, ttl: float = C.PROFILE_CACHE_TTL, max_workers: int = C.PROFILE_FETCH_WORKERS):
+        self.ttl = ttl
+        self._names = {}  # chat_id -> (name, expiry time)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='profiles')
+
+    def remember(self, chat_id, name: str):
+        """Put known name into cache, e.g. when item or transaction is written"""
+        if chat_id is None or not name:
+            return
+        with self._lock:
+            self._names[int(chat_id)] = (name, time.monotonic() + self.ttl)
+
+    def resolve(self, bot, chat_ids: Iterable) -> Dict[int, str]:
+        """Return names of all chat ids, fetching only expired or unknown ones"""
+        result = {}
+        missing = set()
+        now = time.monotonic()
+        with self._lock:
+            for chat_id in chat_ids:
+                if chat_id is None:
+                    continue
+                chat_id = int(chat_id)
+                cached = self._names.get(chat_id)
+                if cached is not None and cached[1] > now:
+                    result[chat_id] = cached[0]
+                else:
+                    missing.add(chat_id)
+
+        futures = {chat_id: self._executor.submit(bot.get_chat, chat_id=chat_id) for chat_id in missing}
+        for chat_id, future in futures.items():
+            try:
+                name = chat_display_name(future.result(), chat_id)
+                self.remember(chat_id, name)
+            except TelegramError as e:
+                # do not cache failures, next page will try again
+                logger.warning(f"get_chat {chat_id} failed: {e}")
+                name = str(chat_id)
+            result[chat_id] = name
+        return result
@@ -0,0 +1,88 @@
+"""
+Access to botDB items and transactions for bot3 handlers.
+Every view reads only the fields it shows, long Images/Files lists and preowned_by arrays are not
+transferred to views which don't use them. Custom categories are arbitrary fields, so views showing
+them exclude fields instead of listing the shown ones.
+"""
+from typing import Any, Dict, Optional, Tuple
+
+import pymongo
+from bson.objectid import ObjectId
+
+import database as DB
+
+# projections of item views
+SEARCH_CARD = {"Files": False, "preowned_by": False, "version": False, "value_cents": False, "categories": False}
+DETAIL = {"preowned_by": False, "version": False, "value_cents": False, "categories": False}
+TRADE_CHECK = DB.TRADE_FIELDS
+ID_ONLY = {"_id": True}
+
+
+class ItemRepository:
+    def __init__(self, db):
+        self.items = db["items"]
+
+    def by_owner(self, chat_id, projection=DETAIL) -> Optional[dict]:
+        return self.items.find_one({"chat_id": chat_id}, projection)
+
+    def by_id(self, item_id, projection=DETAIL) -> Optional[dict]:
+        return self.items.find_one({"_id": ObjectId(item_id)}, projection)
+
+    def page(self, condition, limit: int, after=None, before=None, projection=SEARCH_CARD) -> list:
+        """
+        Items matching condition in _id order, starting after given _id.
+        With before, items preceding it are read backwards and returned in descending _id order.
+        """
+        if before is not None:
+            return list(self.items.find({"$and": [condition, {"_id": {"$lt": before}}]}, projection)
+                        .sort("_id", pymongo.DESCENDING).limit(limit))
+        if after is not None:
+            condition = {"$and": [condition, {"_id": {"$gt": after}}]}
+        return list(self.items.find(condition, projection).sort("_id", pymongo.ASCENDING).limit(limit))
+
+    def preowned_ids(self, chat_id) -> list:
+        """Ids of items the chat owned before, found by the preowned_by index"""
+        return [item['_id'] for item in self.items.find({"preowned_by": chat_id}, ID_ONLY)]
+
+    def by_ids(self, ids: list, condition=None, projection=SEARCH_CARD) -> list:
+        """Items in order of ids, missing ones or ones not matching condition anymore are skipped"""
+        query = {"_id": {"$in": ids}}
+        if condition is not None:
+            query = {"$and": [condition, query]}
+        found = {item['_id']: item for item in self.items.find(query, projection)}
+        return [found[_id] for _id in ids if _id in found]
+
+    def search_text(self, condition, text: str, limit: int) -> list:
+        """Ids of items matching the text, best match first"""
+        cursor = self.items.find(DB.text_search_condition(text, condition), dict(DB.TEXT_SCORE, _id=True))
+        return [item['_id'] for item in cursor.sort(DB.TEXT_SORT).limit(limit)]
+
+    def count(self, condition) -> int:
+        return self.items.count_documents(condition)
+
+    def save(self, facts: Dict[str, Any]) -> Tuple[Any, bool]:
+        """Insert or update the item of facts['chat_id'], returns its _id and whether it was inserted"""
+        facts["categories"] = DB.categories_text(facts)  # facts hold all fields of the item
+        item = self.by_owner(facts['chat_id'], ID_ONLY)
+        if (item is None):
+            facts.setdefault("value_cents", 0)  # item without Value is worth 0 in search
+            return self.items.insert_one(facts).inserted_id, True
+        self.items.update_one({"_id": item['_id'], "chat_id": facts['chat_id']},
+                              {"$set": facts, "$inc": {"version": 1}}, upsert=True)
+        return item['_id'], False
+
+
+class TransactionRepository:
+    def __init__(self, db):
+        self.transactions = db["transactions"]
+
+    def timeline(self, chat_id, offset: int, limit: int) -> Tuple[int, list]:
+        """
+        One page of owner's outcoming trades joined with traded items, newest first.
+        Total count is calculated by the same pipeline, items are looked up for the page rows only.
+        """
+        result = next(self.transactions.aggregate(DB.trade_timeline_pipeline(chat_id, offset, limit)), None)
+        if result is None:
+            return 0, []
+        count = result['total'][0]['count'] if result['total'] else 0
+        return count, result['page']
@@ -0,0 +1,105 @@
+"""
+Start up shared by the bots: Updater built from settings, polling or webhook mode, and counters of incoming updates.
+Polling asks Telegram with a long-poll timeout, so an idle bot waits in one request instead of asking every second,
+and a busy one gets up to POLL_LIMIT updates per request.
+"""
+import os
+import time
+import logging
+from typing import Callable, Optional
+
+from telegram import Update
+from telegram.ext import CallbackContext, ExtBot, TypeHandler, Updater
+from telegram.utils.request import Request
+
+import constants as C
+import metrics
+import outbound
+import webhook
+
+logger = logging.getLogger(__name__)
+
+# counting handler runs before handlers of the bots
+COUNTING_GROUP = -100
+
+
+class PollingBot(outbound.RateLimitedBot):
+    """Rate limited bot asking for POLL_LIMIT updates per getUpdates, sizes of received batches are counted"""
+
+    def get_updates(self, offset: int = None, limit: int = C.POLL_LIMIT, timeout: float = 0, read_latency: float = 2.0,
+                    allowed_updates=None, api_kwargs=None):
+        updates = super().get_updates(offset, limit, timeout, read_latency, allowed_updates, api_kwargs)
+        metrics.increment("polling.requests")
+        metrics.observe("polling.batch", len(updates))
+        return updates
+
+
+def create_bot(workers: int = C.DISPATCHER_WORKERS) -> ExtBot:
+    # connections for dispatcher workers, the polling thread and the job queue
+    request = Request(con_pool_size=workers + 4)
+    return PollingBot(C.TELEGRAM_TOKEN, base_url=C.TELEGRAM_BASE_URL, base_file_url=C.TELEGRAM_BASE_FILE_URL,
+                      request=request)
+
+
+def count_update(update: Update, context: CallbackContext):
+    """Counts every update, its lag since it was sent and updates waiting behind it in the dispatcher"""
+    metrics.increment("updates.received")
+    if (update.message):
+        metrics.observe("updates.lag", max(0.0, time.time() - update.message.date.timestamp()))
+    metrics.observe("updates.queue", context.dispatcher.update_queue.qsize())
+
+
+def log_rate(context: CallbackContext):
+    """Job callback writing updates per second and lag since the previous run to the log"""
+    previous = context.job.context
+    now = time.monotonic()
+    current = metrics.snapshot()
+    received = current.get("updates.received", 0)
+    lag_count = current.get("updates.lag.count", 0)
+    lag_total = current.get("updates.lag.avg", 0.0) * lag_count
+    if previous:
+        elapsed = now - previous["time"]
+        lags = lag_count - previous["lag_count"]
+        lag = (lag_total - previous["lag_total"]) / lags if lags else 0.0
+        logger.info(f"updates: {(received - previous['received']) / elapsed:.2f}/s, lag avg {lag:.2f}s, "
+                    f"max {current.get('updates.lag.max', 0.0):.2f}s, queue max {current.get('updates.queue.max', 0):.0f}, "
+                    f"getUpdates batch avg {current.get('polling.batch.avg', 0.0):.1f}")
+    previous.update(time=now, received=received, lag_count=lag_count, lag_total=lag_total)
+
+
+def new_updater(persistence=None, workers: int = C.DISPATCHER_WORKERS) -> Updater:
+    """Updater of settings with update counters, bots add their handlers and jobs"""
+    updater = Updater(bot=create_bot(workers), workers=workers, persistence=persistence)
+    updater.dispatcher.add_handler(TypeHandler(Update, count_update), group=COUNTING_GROUP)
+    updater.job_queue.run_repeating(log_rate, interval=C.UPDATES_LOG_INTERVAL, first=C.UPDATES_LOG_INTERVAL, context={})
+    return updater
+
+
+def start_polling(updater: Updater):
+    updater.start_polling(poll_interval=C.POLL_INTERVAL, timeout=C.POLL_TIMEOUT,
+                          drop_pending_updates=C.DROP_PENDING_UPDATES)
+
+
+def run(create_updater: Callable[[], Updater], create_worker_updater: Optional[Callable[[], Updater]] = None):
+    """
+    Run the bot until Ctrl-C, SIGINT or SIGTERM: polling without HEROKU_APP_NAME, webhook otherwise.
+    With create_worker_updater (module level function) webhook updates are sharded to WEBHOOK_WORKERS processes.
+    """
+    webhook_url = f"https://{C.HEROKU_APP_NAME}.herokuapp.com/{C.TELEGRAM_TOKEN}"
+    if C.HEROKU_APP_NAME == "":  # polling mode
+        logger.info("Can't detect 'HEROKU_APP_NAME' env. Running bot in polling mode.")
+        updater = create_updater()
+        start_polling(updater)
+    elif (create_worker_updater is not None and C.WEBHOOK_WORKERS > 1):  # webhook mode with worker processes
+        webhook.serve(create_worker_updater, webhook_url, int(os.environ.get('PORT', C.HEROKU_PORT)))
+        return
+    else:  # webhook mode
+        updater = create_updater()
+        updater.start_webhook(
+            listen="0.0.0.0",
+            port=int(os.environ.get('PORT', C.HEROKU_PORT)),
+            url_path=C.TELEGRAM_TOKEN,
+            webhook_url=webhook_url,
+            drop_pending_updates=C.DROP_PENDING_UPDATES
+        )
+    updater.idle()
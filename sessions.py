@@ -0,0 +1,113 @@
+"""
+Thread-safe state of bot1 trades: users' items of conversations in progress and the current bot item.
+"""
+import time
+import threading
+from typing import Callable, Optional, Tuple
+
+import constants as C
+import trade_types as T
+
+
+class TradeSessions:
+    """Users' items by user id, entries not touched for ttl seconds are evicted"""
+
+    def __init__(self, ttl: float = C.TRADE_SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # user id -> [item, bot item version, last access time]
+
+    def start(self, user_id, bot_item_version: int) -> T.TradeItem:
+        """New user's item, trading against bot item of given version"""
+        item = T.TradeItem("")
+        with self._lock:
+            self._entries[user_id] = [item, bot_item_version, time.monotonic()]
+        return item
+
+    def restore(self, user_id, item: T.TradeItem, bot_item_version: int):
+        """Continue trade of the user with existing item"""
+        with self._lock:
+            self._entries[user_id] = [item, bot_item_version, time.monotonic()]
+
+    def _entry(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            raise KeyError(user_id)
+        if time.monotonic() - entry[2] > self.ttl:
+            del self._entries[user_id]
+            raise KeyError(user_id)
+        entry[2] = time.monotonic()
+        return entry
+
+    def __getitem__(self, user_id) -> T.TradeItem:
+        with self._lock:
+            return self._entry(user_id)[0]
+
+    def __contains__(self, user_id) -> bool:
+        with self._lock:
+            try:
+                self._entry(user_id)
+                return True
+            except KeyError:
+                return False
+
+    def version(self, user_id) -> int:
+        """Version of bot item the user started trading with"""
+        with self._lock:
+            return self._entry(user_id)[1]
+
+    def pop(self, user_id) -> Optional[T.TradeItem]:
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+        return entry[0] if entry else None
+
+    def values(self):
+        with self._lock:
+            return [entry[0] for entry in self._entries.values()]
+
+    def evict(self) -> int:
+        """Remove abandoned conversations, returns number of removed ones"""
+        expiry = time.monotonic() - self.ttl
+        with self._lock:
+            expired = [user_id for user_id, entry in self._entries.items() if entry[2] < expiry]
+            for user_id in expired:
+                del self._entries[user_id]
+        return len(expired)
+
+
+class BotItem:
+    """Current item of the bot, replaced as a whole by compare-and-swap on its version"""
+
+    def __init__(self, item: T.TradeItem):
+        self._lock = threading.Lock()
+        self._item = item
+        self._version = 0
+
+    @property
+    def item(self) -> T.TradeItem:
+        return self._item
+
+    def snapshot(self) -> Tuple[T.TradeItem, int]:
+        with self._lock:
+            return self._item, self._version
+
+    def reset(self, item: T.TradeItem):
+        with self._lock:
+            self._item = item
+            self._version += 1
+
+    def compare_and_swap(self, expected_version: int, new_item: T.TradeItem,
+                         on_swap: Callable[[T.TradeItem], None] = None) -> Optional[T.TradeItem]:
+        """
+        Replace item if nobody replaced it since expected version, returns the previous item or None on conflict.
+        on_swap runs under the lock, so e.g. journal order follows swaps order.
+        """
+        with self._lock:
+            if self._version != expected_version:
+                return None
+            if on_swap is not None:
+                on_swap(new_item)
+            previous = self._item
+            self._item = new_item
+            self._version += 1
+            return previous
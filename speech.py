@@ -0,0 +1,164 @@
+"""
+Voice notes to text.
+Recognition runs in a few worker threads fed by a bounded queue, so dispatcher workers are not blocked
+for the whole transcription. Recognizer backends:
+    ibm  - IBM Speech to Text https://cloud.ibm.com/apidocs/speech-to-text?code=python#recognize
+    vosk - local offline engine https://alphacephei.com/vosk/ (optional, needs vosk package, model and ffmpeg)
+C.SPEECH_BACKENDS lists backends in order of preference, next one is used when previous fails.
+"""
+import json
+import queue
+import logging
+import threading
+import subprocess
+from typing import Callable, List, Optional
+
+import constants as C
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram voice notes are OGG container with Opus codec
+VOICE_CONTENT_TYPE = 'audio/ogg;codecs=opus'
+
+
+class RecognitionError(Exception):
+    pass
+
+
+class Recognizer:
+    name = ""
+
+    def recognize(self, audio: bytes, content_type: str = VOICE_CONTENT_TYPE) -> str:
+        """Return transcript of the audio, empty if nothing was recognized"""
+        raise NotImplementedError
+
+
+class IBMRecognizer(Recognizer):
+    name = "ibm"
+
+    def __init__(self, api_key: str = C.IBM_KEY, service_url: str = C.IBM_SERVICE_URL, keywords: List[str] = None):
+        from ibm_watson import SpeechToTextV1
+        from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+        self.client = SpeechToTextV1(authenticator=IAMAuthenticator(api_key))
+        self.client.set_service_url(service_url)
+        self.keywords = keywords or []
+
+    @staticmethod
+    def transcript(result: dict) -> str:
+        """Join best alternatives of all final results"""
+        parts = [r['alternatives'][0]['transcript'].strip() for r in result.get('results', []) if r.get('alternatives')]
+        return " ".join(part for part in parts if part != "")
+
+    def recognize(self, audio: bytes, content_type: str = VOICE_CONTENT_TYPE) -> str:
+        from ibm_cloud_sdk_core import ApiException
+        from requests import RequestException
+        options = {'keywords': self.keywords, 'keywords_threshold': 0.5} if self.keywords else {}
+        try:
+            response = self.client.recognize(audio=audio, content_type=content_type, **options)
+        except (ApiException, RequestException) as e:  # error answer, or connection failed or timed out
+            raise RecognitionError(f"IBM speech to text: {e}") from e
+        return IBMRecognizer.transcript(response.get_result())
+
+
+class VoskRecognizer(Recognizer):
+    name = "vosk"
+    SAMPLE_RATE = 16000
+
+    def __init__(self, model_path: str = C.VOSK_MODEL_PATH, ffmpeg: str = "ffmpeg"):
+        from vosk import Model
+        self.model = Model(model_path)
+        self.ffmpeg = ffmpeg
+
+    def decode(self, audio: bytes) -> bytes:
+        """OGG/Opus to 16kHz mono 16-bit PCM"""
+        try:
+            process = subprocess.run(
+                [self.ffmpeg, '-loglevel', 'error', '-i', 'pipe:0', '-ar', str(self.SAMPLE_RATE), '-ac', '1', '-f', 's16le', 'pipe:1'],
+                input=audio, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise RecognitionError(f"ffmpeg could not decode voice: {e}") from e
+        return process.stdout
+
+    def recognize(self, audio: bytes, content_type: str = VOICE_CONTENT_TYPE) -> str:
+        from vosk import KaldiRecognizer
+        pcm = audio if content_type.startswith('audio/l16') else self.decode(audio)
+        recognizer = KaldiRecognizer(self.model, self.SAMPLE_RATE)
+        recognizer.AcceptWaveform(pcm)
+        return json.loads(recognizer.FinalResult()).get('text', '').strip()
+
+
+class FallbackRecognizer(Recognizer):
+    """Tries recognizers one by one until one of them succeeds"""
+
+    def __init__(self, recognizers: List[Recognizer]):
+        self.recognizers = recognizers
+        self.name = ",".join(r.name for r in recognizers)
+
+    def recognize(self, audio: bytes, content_type: str = VOICE_CONTENT_TYPE) -> str:
+        errors = []
+        for recognizer in self.recognizers:
+            try:
+                return recognizer.recognize(audio, content_type)
+            except RecognitionError as e:
+                metrics.increment(f'speech.{recognizer.name}.failed')
+                errors.append(str(e))
+        raise RecognitionError("; ".join(errors) or "no speech recognizer configured")
+
+
+# backend factories taking keywords to spot, vosk transcribes free text only
+BACKENDS = {
+    IBMRecognizer.name: lambda keywords: IBMRecognizer(keywords=keywords),
+    VoskRecognizer.name: lambda keywords: VoskRecognizer(),
+}
+
+
+def create_recognizer(backends: str = C.SPEECH_BACKENDS, keywords: List[str] = None) -> Recognizer:
+    """Recognizer with fallback over comma separated backends, unavailable ones are skipped"""
+    recognizers = []
+    for name in [b.strip() for b in backends.split(',') if b.strip() != ""]:
+        try:
+            recognizers.append(BACKENDS[name](keywords))
+        except Exception as e:  # missing optional package or model
+            logger.warning(f"Speech backend '{name}' is not available: {e}")
+    return FallbackRecognizer(recognizers)
+
+
+class SpeechQueue:
+    """
+    Bounded queue of voice notes processed by worker threads.
+    Job downloads the voice and calls on_done(transcript) with None if it could not be recognized.
+    """
+
+    def __init__(self, recognizer: Recognizer, workers: int = C.SPEECH_WORKERS, queue_size: int = C.SPEECH_QUEUE_SIZE):
+        self.recognizer = recognizer
+        self._jobs = queue.Queue(maxsize=queue_size)
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f'speech_{i}', daemon=True).start()
+
+    def submit(self, voice, on_done: Callable[[Optional[str]], None]) -> bool:
+        """Queue telegram Voice for recognition, False when queue is full"""
+        try:
+            self._jobs.put_nowait((voice, on_done))
+        except queue.Full:
+            metrics.increment('speech.rejected')
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            voice, on_done = self._jobs.get()
+            transcript = None
+            try:
+                audio = bytes(voice.get_file().download_as_bytearray())
+                transcript = self.recognizer.recognize(audio, voice.mime_type or VOICE_CONTENT_TYPE)
+                metrics.increment('speech.recognized')
+            except Exception as e:
+                metrics.increment('speech.failed')
+                logger.warning(f"Voice recognition failed: {e}")
+            try:
+                on_done(transcript)
+            except Exception:
+                logger.exception("Voice callback failed")
+            finally:
+                self._jobs.task_done()
@@ -0,0 +1,122 @@
+"""
+Stress test of bot3 trade commit. Transactions need a replica set, a local one is enough:
+mongod --replSet rs0 --dbpath /tmp/rs0 && mongo --eval "rs.initiate()"
+
+Usage:
+python stress_trades.py --url "mongodb://localhost:27017/?replicaSet=rs0" --items 20 --trades 2000 --workers 16
+
+Items of the scratch database are traded and edited concurrently, afterwards the invariants are checked:
+every owner has exactly one item, every done trade wrote two transactions,
+item version counts its trades and edits, preowned_by lists all previous owners of the item.
+Exits with error if any invariant is broken.
+"""
+import sys
+import random
+import argparse
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+import database as DB
+from bot3 import Bot
+
+
+def create_items(db, count: int) -> list:
+    db["items"].drop()
+    db["transactions"].drop()
+    DB.ensure_indexes(db)
+    chat_ids = list(range(1, count + 1))
+    db["items"].insert_many([{"chat_id": chat_id, "owner_name": f"owner{chat_id}", "Name": f"item{chat_id}",
+                              "Value": str(random.randint(1, 3))} for chat_id in chat_ids])
+    return chat_ids
+
+
+def run(client, db, chat_ids: list, trades: int, workers: int) -> dict:
+    item_ids = [item["_id"] for item in db["items"].find({}, {"_id": True})]
+    lock = threading.Lock()
+    stats = Counter()
+    edits = Counter()  # item id -> number of edits
+
+    def trade(_):
+        chat_id = random.choice(chat_ids)
+        try:
+            DB.execute_trade(client, db, chat_id, random.choice(item_ids), Bot.trade_validation_error)
+            result = "done"
+        except DB.TradeRejected:
+            result = "rejected"
+        except PyMongoError:
+            result = "failed"
+        with lock:
+            stats[result] += 1
+
+    def edit(_):
+        item = db["items"].find_one_and_update({"chat_id": random.choice(chat_ids)},
+                                               {"$set": {"Value": str(random.randint(1, 3))}, "$inc": {"version": 1}},
+                                               projection={"_id": True})
+        with lock:
+            stats["edits"] += 1
+            if item is not None:
+                edits[item["_id"]] += 1
+
+    jobs = [trade] * trades + [edit] * (trades // 10)
+    random.shuffle(jobs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda job: job(None), jobs))
+    stats["edits by item"] = edits
+    return stats
+
+
+def check(db, chat_ids: list, stats: dict) -> list:
+    """Broken invariants"""
+    errors = []
+    items = list(db["items"].find())
+    owners = Counter(item["chat_id"] for item in items)
+    if sorted(owners.keys()) != sorted(chat_ids) or any(count != 1 for count in owners.values()):
+        errors.append(f"owners don't have exactly one item each: {dict(owners)}")
+
+    transactions = list(db["transactions"].find())
+    if len(transactions) != 2 * stats["done"]:
+        errors.append(f"{stats['done']} trades done, but {len(transactions)} transactions written")
+
+    trades_by_item = Counter(t["item_id"] for t in transactions)
+    previous_owners = defaultdict(set)
+    for t in transactions:
+        previous_owners[t["item_id"]].add(t["from_chat_id"])
+    for item in items:
+        expected = trades_by_item[item["_id"]] + stats["edits by item"][item["_id"]]
+        if item.get("version", 0) != expected:
+            errors.append(f"{item['Name']} has version {item.get('version')}, expected {expected}")
+        if set(item.get("preowned_by", [])) != previous_owners[item["_id"]]:
+            errors.append(f"{item['Name']} preowned_by {item.get('preowned_by')}, "
+                          f"transactions have {sorted(previous_owners[item['_id']])}")
+    return errors
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="concurrent trades against a replica set")
+    parser.add_argument("--url", default="mongodb://localhost:27017/?replicaSet=rs0")
+    parser.add_argument("--db", default="stress_botDB")
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--trades", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args(argv)
+
+    client = pymongo.MongoClient(args.url)
+    db = client[args.db]
+    chat_ids = create_items(db, args.items)
+    stats = run(client, db, chat_ids, args.trades, args.workers)
+    print(f"done: {stats['done']}, rejected: {stats['rejected']}, failed: {stats['failed']}, edits: {stats['edits']}")
+    errors = check(db, chat_ids, stats)
+    for error in errors:
+        print(error)
+    if errors:
+        return 1
+    print("All invariants hold")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+
+import bot2
+import outbound
+
+
+class FakeCursor(list):
+    def sort(self, *args):
+        return self
+
+    def limit(self, count):
+        return FakeCursor(self[:count])
+
+
+def test_search_reply_fits_one_message():
+    items = FakeCursor({'Name': f'item{i}', 'Value': '10', 'Description': 'long ' * 1000} for i in range(20))
+    bot = bot2.Bot.__new__(bot2.Bot)
+    bot.botDB = {'items': SimpleNamespace(find=lambda condition, projection: items)}
+    replies = []
+    update = SimpleNamespace(message=SimpleNamespace(from_user=SimpleNamespace(id=1),
+                                                     reply_text=lambda text, **kwargs: replies.append(text)))
+
+    bot.search_command(update, SimpleNamespace(args=['long']))
+
+    assert len(replies) == 1 and len(replies[0]) <= outbound.MAX_MESSAGE_LENGTH
+    assert 'item0' in replies[0] and 'more found' in replies[0]
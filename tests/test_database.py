@@ -0,0 +1,61 @@
+import bson
+import mongomock
+
+import bot3
+import database as DB
+
+
+def test_value_cents():
+    assert DB.value_cents('$1,250.5') == 125050
+    assert DB.value_cents('0.005') == 1
+    assert DB.value_cents('ten') == 0
+    assert DB.value_cents(None) == 0
+
+
+def test_value_cents_out_of_int64_range_is_zero():
+    for text in ('1e30', '-1e30', '92233720368547758.08', '1e999999999', 'nan', 'sNaN', 'inf', '-Infinity'):
+        assert DB.value_cents(text) == 0, text
+    assert DB.value_cents('92233720368547758.07') == DB.MAX_VALUE_CENTS
+    assert DB.value_cents('-92233720368547758.08') == DB.MIN_VALUE_CENTS
+    bson.encode({'value_cents': DB.value_cents('92233720368547758.07')})
+
+
+def test_bot_migrates_values_of_legacy_items():
+    db = mongomock.MongoClient()["botDB"]
+    db["items"].insert_one({"chat_id": 1, "Name": "legacy", "Value": "$12.5"})
+    bot3.Bot(db, speech_backends="")
+
+    assert db["items"].find_one({"chat_id": 1})["value_cents"] == 1250
+    assert db["items"].count_documents(DB.search_condition(2, 1250)) == 1
+
+
+def test_categories_text_leaves_out_fields_indexed_or_internal():
+    item = {"_id": 1, "chat_id": 2, "Name": "bike", "Description": "red", "Images": "AgAD|AgAE", "Files": "BQAC",
+            "value_cents": 100, "Colour": "green", "Size": "L", "preowned_by": [3]}
+    assert DB.categories_text(item) == "Colour green Size L"
+
+
+def test_save_indexes_categories_and_replaces_wildcard_text_index():
+    db = mongomock.MongoClient()["botDB"]
+    db["items"].create_index([("$**", "text")], name="text")
+    db["items"].insert_one({"chat_id": 1, "Name": "legacy", "Value": "1", "Colour": "green"})
+    bot = bot3.Bot(db, speech_backends="")
+    bot.items.save({"chat_id": 2, "Name": "bike", "Size": "L"})
+
+    indexes = db["items"].index_information()
+    assert "text" not in indexes and "text_fields" in indexes
+    assert db["items"].find_one({"chat_id": 1})["categories"] == "Colour green"
+    assert db["items"].find_one({"chat_id": 2})["categories"] == "Size L"
+    assert "categories" not in bot.items.by_owner(2)
+
+
+def test_search_excludes_preowned_items_by_id():
+    db = mongomock.MongoClient()["botDB"]
+    bot = bot3.Bot(db, speech_backends="")
+    db["items"].insert_many([{"chat_id": 2, "Name": "kept", "value_cents": 0},
+                             {"chat_id": 3, "Name": "preowned", "value_cents": 0, "preowned_by": [1]}])
+    preowned = bot.items.preowned_ids(1)
+
+    assert [item["Name"] for item in db["items"].find(DB.search_condition(1, 0, preowned))] == ["kept"]
+    assert [item["Name"] for item in db["items"].find(DB.search_condition(1, 0))] == ["kept"]
+    assert "preowned_by" in db["items"].index_information()
@@ -0,0 +1,42 @@
+import time
+
+from telegram.error import RetryAfter
+
+import outbound
+
+
+def send_page(limiter: outbound.OutboundLimiter, chat_id: int, messages: int) -> list:
+    sent = []
+    for i in range(messages):
+        # markup keeps messages of a page from being merged
+        limiter.call('sendMessage', {'chat_id': chat_id, 'text': str(i), 'reply_markup': i}, sent.append)
+    return sent
+
+
+def test_search_page_is_sent_without_waiting():
+    limiter = outbound.OutboundLimiter()
+    started = time.monotonic()
+    assert len(send_page(limiter, 5, 12)) == 12
+    assert time.monotonic() - started < 0.5
+
+
+def test_chat_budget_holds_back_longer_bursts():
+    limiter = outbound.OutboundLimiter(global_rate=1000, global_burst=1000, chat_rate=20, chat_burst=2)
+    started = time.monotonic()
+    send_page(limiter, 5, 4)
+    # two messages of the burst and two more at 20 per second
+    assert time.monotonic() - started >= 0.09
+
+
+def test_retry_after_is_sent_again():
+    limiter = outbound.OutboundLimiter()
+    attempts = []
+
+    def send(data):
+        attempts.append(data)
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        return data
+
+    assert limiter.call('editMessageText', {'chat_id': 5, 'text': 'x'}, send) == {'chat_id': 5, 'text': 'x'}
+    assert len(attempts) == 2
@@ -0,0 +1,30 @@
+import pickle
+
+from persistence import BatchedPersistence, SQLiteStore, USER_DATA
+
+
+def without_expired(user_data: dict) -> dict:
+    return {key: value for key, value in user_data.items() if key != 'expired'}
+
+
+def test_flush_drops_expired_user_data(tmp_path):
+    store = SQLiteStore(str(tmp_path / "persistence.db"))
+    persistence = BatchedPersistence(store, without_expired)
+    persistence.update_user_data(1, {'expired': 1, 'kept': 2})
+    persistence.update_user_data(2, {'expired': 1})
+    persistence.flush()
+
+    assert pickle.loads(store.load(USER_DATA, "1")) == {'kept': 2}
+    assert store.load(USER_DATA, "2") is None
+
+
+def test_flush_deletes_user_data_which_expired_since_load(tmp_path):
+    store = SQLiteStore(str(tmp_path / "persistence.db"))
+    store.save({(USER_DATA, "1"): pickle.dumps({'expired': 1})})
+    persistence = BatchedPersistence(store, without_expired)
+    user_data = persistence.get_user_data()[1]
+    persistence.update_user_data(1, user_data)
+    persistence.flush()
+
+    assert user_data == {'expired': 1}  # data of the dispatcher is not changed
+    assert store.load(USER_DATA, "1") is None
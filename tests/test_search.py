@@ -0,0 +1,165 @@
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+from telegram.utils.request import Request
+
+import bot3
+import fake_telegram
+
+CHAT_ID = 5
+calls = []
+
+
+class RecordingRequest(Request):
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        calls.append((method, data))
+        return fake_telegram.answer(method, data)
+
+
+def methods() -> list:
+    return [method for method, _ in calls]
+
+
+class FakeItems:
+    def __init__(self, count: int):
+        self.items = {i: {'_id': i, 'chat_id': 100 + i, 'owner_name': f'owner{i}', 'Name': f'item{i}'}
+                      for i in range(count)}
+
+    def by_owner(self, chat_id, projection=None):
+        return None
+
+    def preowned_ids(self, chat_id) -> list:
+        return []
+
+    def search_text(self, condition, text: str, limit: int) -> list:
+        return list(self.items)[:limit]
+
+    def by_ids(self, ids: list, condition=None, projection=None) -> list:
+        return [self.items[i] for i in ids]
+
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+def create_bot(count: int) -> bot3.Bot:
+    bot = bot3.Bot.__new__(bot3.Bot)
+    bot.items = FakeItems(count)
+    bot.profiles = SimpleNamespace(resolve=lambda telegram_bot, chat_ids: {})
+    bot.media = SimpleNamespace(render=lambda telegram_bot, chat_id, albums: [])
+    bot.cleanup = InlineExecutor()
+    return bot
+
+
+def message_update(telegram_bot: Bot, text: str) -> Update:
+    return Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': text,
+        'chat': {'id': CHAT_ID, 'type': 'private'},
+        'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'user'}}}, telegram_bot)
+
+
+def button_update(telegram_bot: Bot, message_id: int, text: str, data: str) -> Update:
+    return Update.de_json({'update_id': 2, 'callback_query': {
+        'id': '1', 'chat_instance': '1', 'data': data,
+        'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'user'},
+        'message': {'message_id': message_id, 'date': 0, 'text': text,
+                    'chat': {'id': CHAT_ID, 'type': 'private'}}}}, telegram_bot)
+
+
+def test_text_search_paging_sends_new_header():
+    calls.clear()
+    telegram_bot = Bot("123456:test", request=RecordingRequest())
+    bot = create_bot(bot3.PAGE_SIZE + 2)
+    context = SimpleNamespace(bot=telegram_bot, chat_data={}, user_data={})
+
+    assert bot.search_text_filter(message_update(telegram_bot, 'item'), context) == bot3.SEARCHING
+    sent = [(method, data) for method, data in calls if method == 'sendMessage']
+    assert sent[0][1]['text'].startswith('Page 1 of 2.')
+    assert len(sent) == 1 + bot3.PAGE_SIZE
+    # page messages are the typed query, the header and the items
+    header_id = list(bot3.pages.messages_of(context.chat_data, bot3.PAGE_MASSAGES))[1]
+
+    calls.clear()
+    bot.search(button_update(telegram_bot, header_id, sent[0][1]['text'], str(bot3.NEXT_PAGE)), context)
+
+    # the clicked header was deleted with the page, the next page comes with a new one instead of an edit
+    assert 'editMessageText' not in methods()
+    assert ('deleteMessage', {'chat_id': CHAT_ID, 'message_id': header_id}) in calls
+    sent = [data for method, data in calls if method == 'sendMessage']
+    assert sent[0]['text'].startswith('Page 2 of 2.')
+    assert len(sent) == 1 + 2
+    assert methods().index('answerCallbackQuery') < methods().index('sendMessage')
+
+
+@contextmanager
+def pending_search():
+    """Dispatcher of a bot with a search handler of the chat running until the block exits"""
+    calls.clear()
+    started, release = threading.Event(), threading.Event()
+    bot = create_bot(0)
+
+    def search(update, context):
+        started.set()
+        release.wait(5)
+        return bot3.SEARCHING
+
+    bot.search = search
+    updater = Updater(bot=Bot("123456:test", request=RecordingRequest(con_pool_size=8)), workers=2)
+    dispatcher = updater.dispatcher
+    bot.add_handlers(dispatcher)
+    main = next(handler for handler in dispatcher.handlers[0] if getattr(handler, 'name', None) == 'main')
+    main.conversations[(CHAT_ID, CHAT_ID)] = bot3.SELECTING_ACTION
+    ready = threading.Event()
+    thread = threading.Thread(target=dispatcher.start, kwargs={'ready': ready}, daemon=True)
+    thread.start()
+    assert ready.wait(5)
+    try:
+        dispatcher.update_queue.put(button_update(updater.bot, 10, 'menu', str(bot3.SEARCHING)))
+        assert started.wait(5)
+        yield updater.bot, dispatcher
+    finally:
+        release.set()
+        dispatcher.stop()
+        thread.join()
+    # the conversation is still pending on the search, not on the answered update
+    previous, pending = main.conversations[(CHAT_ID, CHAT_ID)]
+    assert previous == bot3.SELECTING_ACTION and pending.result() == bot3.SEARCHING
+
+
+def test_button_pressed_while_search_runs_is_answered():
+    with pending_search() as (telegram_bot, dispatcher):
+        dispatcher.update_queue.put(button_update(telegram_bot, 10, 'menu', str(bot3.NEXT_PAGE)))
+        dispatcher.update_queue.join()
+    answers = [data for method, data in calls if method == 'answerCallbackQuery']
+    assert len(answers) == 1 and 'Please wait' in answers[0]['text']
+
+
+def test_message_sent_while_search_runs_is_answered():
+    with pending_search() as (telegram_bot, dispatcher):
+        dispatcher.update_queue.put(message_update(telegram_bot, 'item'))
+        dispatcher.update_queue.join()
+    sent = [data for method, data in calls if method == 'sendMessage']
+    assert len(sent) == 1 and 'Please wait' in sent[0]['text']
+
+
+def test_typed_query_looks_up_value_of_the_chat_item_again():
+    calls.clear()
+    telegram_bot = Bot("123456:test", request=RecordingRequest())
+    bot = create_bot(1)
+    values = iter([{'value_cents': 100}, {'value_cents': 500}])
+    bot.items.by_owner = lambda chat_id, projection=None: next(values)
+    conditions = []
+    search_text = bot.items.search_text
+    bot.items.search_text = lambda condition, text, limit: conditions.append(condition) or search_text(condition, text, limit)
+    context = SimpleNamespace(bot=telegram_bot, chat_data={}, user_data={})
+
+    bot.search_text_filter(message_update(telegram_bot, 'item'), context)
+    bot.search_text_filter(message_update(telegram_bot, 'item'), context)
+
+    assert [condition['$and'][-1] for condition in conditions] == [{'value_cents': {'$lte': 100}},
+                                                                    {'value_cents': {'$lte': 500}}]
@@ -0,0 +1,45 @@
+import requests
+
+import speech
+
+
+class FakeResponse:
+    def get_result(self):
+        return {'results': [{'alternatives': [{'transcript': 'save '}]}]}
+
+
+class FakeClient:
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.options = None
+
+    def recognize(self, audio, content_type, **options):
+        self.options = options
+        if self.error is not None:
+            raise self.error
+        return FakeResponse()
+
+
+class StaticRecognizer(speech.Recognizer):
+    name = "static"
+
+    def recognize(self, audio, content_type=speech.VOICE_CONTENT_TYPE):
+        return "fallback"
+
+
+def ibm_recognizer(client: FakeClient) -> speech.IBMRecognizer:
+    recognizer = speech.BACKENDS[speech.IBMRecognizer.name](['save', 'back'])
+    recognizer.client = client
+    return recognizer
+
+
+def test_ibm_gets_keywords():
+    client = FakeClient()
+    assert ibm_recognizer(client).recognize(b"voice") == "save"
+    assert client.options == {'keywords': ['save', 'back'], 'keywords_threshold': 0.5}
+
+
+def test_ibm_connection_errors_fall_back():
+    for error in (requests.ConnectionError("refused"), requests.Timeout("timed out")):
+        recognizer = speech.FallbackRecognizer([ibm_recognizer(FakeClient(error)), StaticRecognizer()])
+        assert recognizer.recognize(b"voice") == "fallback"
@@ -0,0 +1,90 @@
+import queue
+import time
+
+from telegram import Bot
+from telegram.ext import ConversationHandler, Filters, MessageHandler, Updater
+from telegram.utils.request import Request
+
+import fake_telegram
+import webhook
+
+ASKED, = range(1)
+handled = []
+
+
+def message(update_id: int, chat_id: int, text: str) -> dict:
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}}}
+
+
+def ask(update, context):
+    handled.append(('ask', update.message.text))
+    return ASKED
+
+
+def answer(update, context):
+    handled.append(('answer', update.message.text))
+    return ConversationHandler.END
+
+
+class FakeRequest(Request):
+    def post(self, url, data, timeout=None):
+        return fake_telegram.answer(url.rsplit('/', 1)[-1], data)
+
+
+def create_updater() -> Updater:
+    updater = Updater(bot=Bot("123456:test", request=FakeRequest(con_pool_size=8)), workers=2)
+    updater.dispatcher.add_handler(ConversationHandler(
+        entry_points=[MessageHandler(Filters.regex('^ask$'), ask, run_async=True)],
+        states={ASKED: [MessageHandler(Filters.text, answer, run_async=True)]},
+        fallbacks=[],
+    ))
+    return updater
+
+
+def test_run_worker_runs_async_handlers():
+    handled.clear()
+    updates = queue.Queue()
+    updates.put(message(1, 5, 'ask'))
+    updates.put(message(2, 5, 'yes'))
+    updates.put(None)
+
+    webhook.run_worker(create_updater, 0, updates)
+
+    # the second update reached the state returned by the first async handler
+    assert handled == [('ask', 'ask'), ('answer', 'yes')]
+
+
+def test_shard_key():
+    assert webhook.shard_key(message(1, 5, 'hi')) == 5
+    assert webhook.shard_key({'update_id': 1, 'callback_query': {
+        'id': '1', 'from': {'id': 7}, 'message': {'chat': {'id': -100}}}}) == -100
+    assert webhook.shard_key({'update_id': 1, 'inline_query': {'from': {'id': 7}}}) == 7
+    assert webhook.shard_key({'update_id': 1, 'poll': {}}) == 0
+
+
+class BusyProcess:
+    terminated = False
+
+    def join(self, timeout=None):
+        pass
+
+    def is_alive(self) -> bool:
+        return not self.terminated
+
+    def terminate(self):
+        self.terminated = True
+
+
+def test_stop_does_not_wait_for_full_queue_beyond_timeout():
+    front_end = webhook.FrontEnd(create_updater, workers=1, queue_size=1)
+    front_end.processes = [BusyProcess()]
+    assert front_end.submit(message(1, 5, 'ask'))
+
+    started = time.monotonic()
+    front_end.stop(timeout=0.2)
+
+    assert time.monotonic() - started < 2
+    assert front_end.processes[0].terminated
@@ -0,0 +1,66 @@
+"""
+Thumbnails of uploaded photos are made in a process pool as soon as photo is downloaded,
+so Pillow work does not hold dispatcher threads. Commit only waits for thumbnails still in progress.
+"""
+import logging
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from PIL import Image
+
+import constants as C
+
+logger = logging.getLogger(__name__)
+
+
+def make_thumbnail(path: str, thumbnail_path: str, size: int) -> str:
+    """Runs in pool process"""
+    with Image.open(path) as image:
+        image.thumbnail((size, size))
+        image.save(thumbnail_path)
+    return thumbnail_path
+
+
+class ThumbnailPipeline:
+    def __init__(self, workers: int = C.THUMBNAIL_WORKERS, queue_depth: int = C.THUMBNAIL_QUEUE_DEPTH):
+        self.workers = workers
+        self._pool = None  # created on first use, not at import
+        self._slots = threading.BoundedSemaphore(queue_depth)
+        self._lock = threading.Lock()
+        self._futures: Dict[str, Future] = {}  # thumbnail path -> future
+
+    def submit(self, path: str, thumbnail_path: str, size: int) -> bool:
+        """Start thumbnail in background, False if queue is full and it should be made on commit"""
+        if not self._slots.acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                future = self._pool.submit(make_thumbnail, path, thumbnail_path, size)
+                self._futures[thumbnail_path] = future
+        except RuntimeError as e:  # pool is broken or shut down
+            self._slots.release()
+            logger.warning(f"Thumbnail {thumbnail_path} not started: {e}")
+            return False
+        future.add_done_callback(lambda f: self._done(thumbnail_path, f))
+        return True
+
+    def _done(self, thumbnail_path: str, future: Future):
+        self._slots.release()
+        with self._lock:
+            if self._futures.get(thumbnail_path) is future:
+                del self._futures[thumbnail_path]
+        if future.exception() is not None:
+            logger.warning(f"Thumbnail {thumbnail_path} failed: {future.exception()}")
+
+    def wait(self, thumbnail_paths: Iterable[str], timeout: Optional[float] = None):
+        """Wait for thumbnails still in progress, failed ones are left for the caller to make"""
+        with self._lock:
+            futures = [(p, self._futures.pop(p)) for p in thumbnail_paths if p in self._futures]
+        for thumbnail_path, future in futures:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass  # logged by _done
@@ -0,0 +1,214 @@
+"""
+Webhook front end running a bot in several worker processes.
+The front end accepts updates from Telegram and shards them by chat id, so all updates of one chat are handled
+by the same process, in order, and its ConversationHandler sees every step of a conversation.
+Every worker has a bounded queue. When the queue of a chat is full the update is answered with 503,
+Telegram delivers it again later and holds the next updates back meanwhile.
+"""
+import json
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Full
+from typing import Callable
+
+from telegram import Bot as TelegramBot, Update
+from telegram.ext import Updater
+
+import constants as C
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# updates with chat, other updates are sharded by the user
+CHAT_UPDATES = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'my_chat_member', 'chat_member', 'chat_join_request')
+USER_UPDATES = ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query')
+
+
+def shard_key(data: dict) -> int:
+    """Chat id of the update, id of the user for updates without chat, 0 for the rest (polls)"""
+    for field in CHAT_UPDATES:
+        if field in data:
+            return data[field]['chat']['id']
+    if 'callback_query' in data:
+        query = data['callback_query']
+        return query['message']['chat']['id'] if 'message' in query else query['from']['id']
+    for field in USER_UPDATES:
+        if field in data:
+            return data[field]['from']['id']
+    if 'poll_answer' in data:
+        return data['poll_answer']['user']['id']
+    return 0
+
+
+def run_worker(create_updater: Callable[[], Updater], shard: int, updates):
+    """
+    Worker process: runs the dispatcher of its shard, as a single process bot does, so handlers registered
+    with run_async run in dispatcher worker threads. Updates are passed to the dispatcher one by one,
+    the rest waits in the bounded queue of the front end.
+    """
+    updater = create_updater()
+    dispatcher = updater.dispatcher
+    ready = threading.Event()
+    thread = threading.Thread(target=dispatcher.start, kwargs={'ready': ready}, name=f"dispatcher-{shard}", daemon=True)
+    thread.start()
+    while not ready.wait(1):
+        if not thread.is_alive():  # exits the worker, the front end starts a new one
+            raise RuntimeError(f"Dispatcher of webhook worker {shard} did not start")
+    updater.job_queue.start()
+    logger.info(f"Webhook worker {shard} started")
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        try:
+            dispatcher.update_queue.put(Update.de_json(data, updater.bot))
+        except Exception as e:
+            logger.error(f"Webhook worker {shard} could not read update {data.get('update_id')}: {e}")
+            continue
+        dispatcher.update_queue.join()  # until the dispatcher took it, async handlers may still run
+    updater.job_queue.stop()
+    dispatcher.stop()  # waits for running async handlers
+    thread.join()
+    if (dispatcher.persistence):
+        dispatcher.update_persistence()
+        dispatcher.persistence.flush()
+    logger.info(f"Webhook worker {shard} stopped")
+
+
+class FrontEnd:
+    """Worker processes with their queues, restarted when they die"""
+
+    def __init__(self, create_updater: Callable[[], Updater], workers: int, queue_size: int = C.WEBHOOK_QUEUE_SIZE):
+        # workers start from scratch, nothing of the front end (sockets, threads, clients) is inherited
+        self._context = multiprocessing.get_context("spawn")
+        self.create_updater = create_updater
+        self.queues = [self._context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+
+    def _start(self, shard: int):
+        process = self._context.Process(target=run_worker, args=(self.create_updater, shard, self.queues[shard]),
+                                        name=f"webhook-worker-{shard}", daemon=True)
+        process.start()
+        self.processes[shard] = process
+
+    def start(self):
+        for shard in range(len(self.queues)):
+            self._start(shard)
+
+    def check(self):
+        """Restart dead workers, updates waiting in their queues are handled by the new ones"""
+        for shard, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error(f"Webhook worker {shard} exited with {process.exitcode}, restarting")
+                metrics.increment("webhook.worker_restarts")
+                self._start(shard)
+
+    def submit(self, data: dict) -> bool:
+        """Queue update to the worker of its chat, False if the queue is full"""
+        shard = shard_key(data) % len(self.queues)
+        try:
+            self.queues[shard].put_nowait(data)
+        except Full:
+            return False
+        return True
+
+    def stop(self, timeout: float = C.WEBHOOK_STOP_TIMEOUT):
+        """Let workers finish queued updates and flush persistence, the ones still busy after timeout are terminated"""
+        deadline = time.monotonic() + timeout
+        for shard, updates in enumerate(self.queues):
+            try:
+                updates.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except Full:  # worker did not make room in time, it is terminated with its queued updates
+                logger.warning(f"Webhook worker {shard} did not take the stop request in time")
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+
+    def depths(self) -> list:
+        return [updates.qsize() for updates in self.queues]
+
+
+class WebhookServer(ThreadingHTTPServer):
+    # Telegram opens up to max_connections connections at once
+    request_queue_size = C.WEBHOOK_MAX_CONNECTIONS
+    daemon_threads = True
+
+
+def handler_class(front_end: FrontEnd, url_path: str, secret_token: str):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: dict, headers: dict = None):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            if (self.path.lstrip('/') != url_path):
+                self._reply(404, {"error": "not found"})
+                return
+            if (secret_token and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token):
+                self._reply(403, {"error": "forbidden"})
+                return
+            try:
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                accepted = front_end.submit(data)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Malformed update: {e}")
+                metrics.increment("webhook.malformed")
+                self._reply(400, {"error": "malformed update"})
+                return
+            if not accepted:
+                metrics.increment("webhook.rejected")
+                self._reply(503, {"error": "busy"}, {"Retry-After": str(C.WEBHOOK_RETRY_AFTER)})
+                return
+            metrics.increment("webhook.accepted")
+            self._reply(200, {})
+
+        def do_GET(self):
+            """Health check with depth of worker queues"""
+            self._reply(200, {"queues": front_end.depths(), "metrics": metrics.snapshot()})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return WebhookHandler
+
+
+def serve(create_updater: Callable[[], Updater], webhook_url: str, port: int, workers: int = C.WEBHOOK_WORKERS,
+          url_path: str = C.TELEGRAM_TOKEN, secret_token: str = C.WEBHOOK_SECRET_TOKEN):
+    """
+    Run the front end until SIGINT/SIGTERM. create_updater must be a module level function, it's called
+    in every worker process to build the bot with its handlers and jobs.
+    """
+    front_end = FrontEnd(create_updater, workers)
+    front_end.start()
+    server = WebhookServer(("0.0.0.0", port), handler_class(front_end, url_path, secret_token))
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    threading.Thread(target=server.serve_forever, name="webhook-server", daemon=True).start()
+    TelegramBot(C.TELEGRAM_TOKEN, base_url=C.TELEGRAM_BASE_URL).set_webhook(
+        url=webhook_url, max_connections=C.WEBHOOK_MAX_CONNECTIONS, secret_token=secret_token or None,
+        drop_pending_updates=C.DROP_PENDING_UPDATES)
+    logger.info(f"Webhook front end listening on port {port} with {workers} workers")
+
+    while not stopping.wait(1):
+        front_end.check()
+
+    server.shutdown()
+    server.server_close()
+    front_end.stop()